@@ -1,30 +1,138 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import os, subprocess, json
-from flask import Flask, request
+import os, subprocess, json, tempfile, threading, functools
+from flask import Flask, Request, request
+from werkzeug.utils import secure_filename
+from model_worker import ModelWorkerPool, ModelWorkerError
+
+# Uploads are streamed into a memory backed filesystem instead of being saved
+# to disk, read back and deleted. In a container, make /dev/shm large enough
+# for the biggest concurrent uploads (docker run --shm-size).
+spool_folder = os.environ.get("INFERENCE_SPOOL_DIR",
+        "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir())
+
+
+class SpoolingRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        """Stream each uploaded file into its own uniquely named file of the spool folder.
+
+        The file is deleted when the request is closed, and its unique name
+        keeps concurrent uploads of the same filename apart.
+        """
+        suffix = os.path.splitext(secure_filename(filename or ""))[1]
+        return tempfile.NamedTemporaryFile(dir=spool_folder, prefix="upload_", suffix=suffix)
+
 
 app = Flask(__name__)
+app.request_class = SpoolingRequest
+
+# INFERENCE_MODE=subprocess runs run_demo.sh for every file.
+# INFERENCE_MODE=worker keeps INFERENCE_WORKERS processes with the model
+# INFERENCE_MODEL ("module:callable", see model_worker.py) loaded.
+# The pool is started in __main__ so that spawned workers do not start their own.
+inference_mode = os.environ.get("INFERENCE_MODE", "subprocess")
+worker_pool = None
+
+# Requests admitted at once (inferring or waiting for a model worker), set in __main__.
+# Beyond that, requests are answered 503 instead of queueing up latency.
+inflight = None
+retry_after = os.environ.get("INFERENCE_RETRY_AFTER", "1")
+
 
-uploads_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), "uploads/")
-if not os.path.exists(uploads_folder):
-    os.makedirs(uploads_folder)
+def limit_inflight(view):
+    """Reject the request with 503 and Retry-After when the server is saturated"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if inflight is None:
+            return view(*args, **kwargs)
+        if not inflight.acquire(blocking=False):
+            return {"answer": "Server busy, retry later."}, 503, {"Retry-After": retry_after}
+        try:
+            return view(*args, **kwargs)
+        finally:
+            inflight.release()
+    return wrapper
+
+
+def run_inference(f):
+    """Run the model on an uploaded file and return its output"""
+    # Already spooled by SpoolingRequest, make sure it is complete for the readers
+    f.stream.flush()
+    fpath = f.stream.name
+    print("File '%s' spooled to '%s'" % (f.filename, fpath))
+    if worker_pool:
+        return worker_pool.infer(fpath)
+    result = subprocess.run(["/wmlce/data/run_demo.sh", fpath],
+            stdout=subprocess.PIPE)
+    return json.loads(result.stdout.decode("utf-8"))
 
 
 @app.route("/infer", methods=["POST"])
+@limit_inflight
 def infer():
     if "file" in request.files:
         print("'file' found.")
-        f = request.files["file"]
-        fpath = os.path.join(uploads_folder, f.filename) 
-        f.save(fpath)
-        print("File '%s' saved to '%s'" % (f.filename, fpath))
-        result = subprocess.run(["/wmlce/data/run_demo.sh", fpath],
-                stdout=subprocess.PIPE)
-        os.remove(fpath)
-        return  json.loads(result.stdout.decode("utf-8"))
+        try:
+            return run_inference(request.files["file"])
+        except ModelWorkerError as e:
+            return {"answer": "Inference failed: %s" % e}, 500
     else:
         return {"answer": "No 'file' provided."}
 
+
+@app.route("/infer_batch", methods=["POST"])
+@limit_inflight
+def infer_batch():
+    """Infer every file of a multipart request, results are keyed by filename"""
+    files = request.files.getlist("files")
+    if not files:
+        return {"answer": "No 'files' provided."}
+    print("%d 'files' found." % len(files))
+    results = []
+    for f in files:
+        # One failing file must not fail the whole batch
+        try:
+            result = run_inference(f)
+        except json.JSONDecodeError as e:
+            result = {"error": "Invalid inference output: %s" % e}
+        except ModelWorkerError as e:
+            result = {"error": "Inference failed: %s" % e}
+        result["filename"] = f.filename
+        results.append(result)
+    return {"results": results}
+
+
+@app.route("/health", methods=["GET"])
+def health():
+    """Report whether the model workers are up, restarting crashed ones"""
+    if not worker_pool:
+        return {"mode": inference_mode, "healthy": True}
+    status = worker_pool.health()
+    return status, 200 if status["healthy"] else 503
+
 if __name__=="__main__":
-    app.run(host="0.0.0.0", port=5000)
+    if inference_mode == "worker":
+        model_spec = os.environ.get("INFERENCE_MODEL")
+        if not model_spec:
+            raise SystemExit("INFERENCE_MODEL is required when INFERENCE_MODE is 'worker'.")
+        worker_pool = ModelWorkerPool(model_spec,
+                size=int(os.environ.get("INFERENCE_WORKERS", "1")),
+                timeout=float(os.environ.get("INFERENCE_TIMEOUT", "300")),
+                retry_delay=float(os.environ.get("INFERENCE_RESTART_DELAY", "10")))
+    elif inference_mode != "subprocess":
+        raise SystemExit("INFERENCE_MODE must be 'subprocess' or 'worker'.")
+
+    port = int(os.environ.get("INFERENCE_PORT", "5000"))
+    if os.environ.get("INFERENCE_SERVER", "development") == "production":
+        from waitress import serve
+        workers = int(os.environ.get("INFERENCE_WORKERS", "1"))
+        max_inflight = int(os.environ.get("INFERENCE_MAX_INFLIGHT", str(2 * workers)))
+        inflight = threading.BoundedSemaphore(max_inflight)
+        # A few threads more than admitted requests, so that overflowing
+        # requests get their 503 right away instead of waiting for a thread
+        threads = max_inflight + 4
+        print("Serving with %d threads, %d requests in flight at most" % (threads, max_inflight))
+        serve(app, host="0.0.0.0", port=port, threads=threads)
+    else:
+        app.run(host="0.0.0.0", port=port)
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Load test of the inference API.
+
+Sends files to /infer at several concurrency levels and reports the latency
+percentiles and the throughput of each level. With --start-server, the API is
+started in production mode with the stub model, so no GPU is needed:
+
+    python3 load_test.py --start-server --workers 2 --latency 0.2 --concurrency 1,2,4,8,16
+"""
+
+import os
+import sys
+import time
+import argparse
+import threading
+import subprocess
+import numpy as np
+import requests
+from concurrent.futures import ThreadPoolExecutor
+
+
+def start_server(args):
+    """Start the inference API with the stub model and wait until it is healthy"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ,
+               INFERENCE_MODE="worker",
+               INFERENCE_MODEL="stub_model:StubModel",
+               INFERENCE_SERVER="production",
+               INFERENCE_PORT=str(args.port),
+               INFERENCE_WORKERS=str(args.workers),
+               STUB_MODEL_LATENCY=str(args.latency))
+    if args.max_inflight:
+        env["INFERENCE_MAX_INFLIGHT"] = str(args.max_inflight)
+    server = subprocess.Popen([sys.executable, os.path.join(here, "inference-flask-api.py")],
+                              env=env, cwd=here, stdout=subprocess.DEVNULL)
+    health_url = "http://localhost:%d/health" % args.port
+    for _ in range(120):
+        try:
+            if requests.get(health_url).ok:
+                return server
+        except requests.exceptions.ConnectionError:
+            pass
+        if server.poll() is not None:
+            raise SystemExit("The inference API exited with code %d" % server.returncode)
+        time.sleep(0.5)
+    server.kill()
+    raise SystemExit("The inference API did not become healthy")
+
+
+def run_level(url, payload, concurrency, count):
+    """Send count requests with concurrency clients, return latencies and status codes"""
+    local = threading.local()
+
+    def send(_):
+        # One keep-alive session per client thread
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        start = time.perf_counter()
+        try:
+            status = local.session.post(url, files={"file": ("load_test.dcm", payload)}).status_code
+        except requests.exceptions.RequestException:
+            status = None
+        return time.perf_counter() - start, status
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(send, range(count)))
+    return time.perf_counter() - start, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="URL of the /infer endpoint (default: the started server)")
+    parser.add_argument("--concurrency", default="1,2,4,8,16", help="comma separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=100, help="requests per concurrency level")
+    parser.add_argument("--size", type=int, default=512 * 1024, help="size in bytes of the uploaded file")
+    parser.add_argument("--file", help="upload this file instead of random bytes")
+    parser.add_argument("--start-server", action="store_true", help="start the API with the stub model")
+    parser.add_argument("--port", type=int, default=5757, help="port of the started server")
+    parser.add_argument("--workers", type=int, default=2, help="model workers of the started server")
+    parser.add_argument("--max-inflight", type=int, help="INFERENCE_MAX_INFLIGHT of the started server")
+    parser.add_argument("--latency", type=float, default=0.1, help="stub model latency in seconds")
+    args = parser.parse_args()
+
+    if args.file:
+        with open(args.file, "rb") as f:
+            payload = f.read()
+    else:
+        payload = os.urandom(args.size)
+
+    server = start_server(args) if args.start_server else None
+    url = args.url or "http://localhost:%d/infer" % args.port
+    try:
+        print("%11s %8s %6s %6s %10s %10s %10s" % (
+            "concurrency", "requests", "503", "errors", "p50 (ms)", "p99 (ms)", "req/s"))
+        for concurrency in [int(c) for c in args.concurrency.split(",")]:
+            elapsed, results = run_level(url, payload, concurrency, args.requests)
+            latencies = np.array([latency for latency, status in results if status == 200]) * 1000
+            busy = sum(1 for _, status in results if status == 503)
+            errors = len(results) - len(latencies) - busy
+            p50, p99 = np.percentile(latencies, [50, 99]) if len(latencies) else (np.nan, np.nan)
+            print("%11d %8d %6d %6d %10.1f %10.1f %10.1f" % (
+                concurrency, len(results), busy, errors, p50, p99, len(latencies) / elapsed))
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    main()
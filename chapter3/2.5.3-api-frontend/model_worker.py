@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Resident model workers for the inference API.
+
+Each worker is a long-lived process that loads the model once and then
+receives inference jobs over a pipe, instead of paying for interpreter
+startup and model loading on every request.
+
+The model is given as "module:callable", the callable returning an object
+with a predict(path) method. predict() must return the same dictionary
+that run_demo.sh prints: model_version, filename_seg, obj_count, result.
+See stub_model.py for an example usable without a GPU.
+"""
+
+import os
+import time
+import queue
+import threading
+import importlib
+import multiprocessing
+
+
+class ModelWorkerError(Exception):
+    """Raised when a job could not be run by a model worker"""
+
+
+class ModelWorkerLost(ModelWorkerError):
+    """Raised when a model worker died or stopped answering"""
+
+
+def load_model(model_spec):
+    """Import and instantiate the model described by 'module:callable'"""
+    module_name, _, factory = model_spec.partition(":")
+    module = importlib.import_module(module_name)
+    return getattr(module, factory or "Model")()
+
+
+def worker_main(conn, model_spec):
+    """Worker process loop: load the model once, then serve jobs until told to stop"""
+    try:
+        model = load_model(model_spec)
+    except Exception as e:
+        conn.send(("error", "Could not load model %s: %s" % (model_spec, e)))
+        return
+    conn.send(("ready", getattr(model, "version", None)))
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            # The parent went away
+            return
+        if job is None:
+            return
+        command, arg = job
+        if command == "ping":
+            conn.send(("pong", os.getpid()))
+            continue
+        try:
+            conn.send(("ok", model.predict(arg)))
+        except Exception as e:
+            conn.send(("error", "%s: %s" % (type(e).__name__, e)))
+
+
+class ModelWorker():
+    """A model worker process and the parent end of its pipe"""
+
+    def __init__(self, context, model_spec, load_timeout):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=worker_main, args=(child_conn, model_spec), daemon=True)
+        self.process.start()
+        child_conn.close()
+        if not self.conn.poll(load_timeout):
+            self.stop()
+            raise ModelWorkerError("Model worker did not load %s within %ss" % (model_spec, load_timeout))
+        status, self.model_version = self.conn.recv()
+        if status != "ready":
+            self.stop()
+            raise ModelWorkerError(self.model_version)
+
+    def call(self, command, arg, timeout):
+        """Send a job and wait for its answer"""
+        try:
+            self.conn.send((command, arg))
+            if not self.conn.poll(timeout):
+                raise ModelWorkerLost("Model worker %d timed out" % self.process.pid)
+            status, result = self.conn.recv()
+        except (EOFError, OSError) as e:
+            raise ModelWorkerLost("Model worker %d died: %s" % (self.process.pid, e))
+        if status == "error":
+            raise ModelWorkerError(result)
+        return result
+
+    def is_alive(self):
+        return self.process.is_alive()
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except (OSError, ValueError):
+            pass
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+
+class ModelWorkerPool():
+    """
+    A fixed size pool of resident model workers.
+
+    A request takes an idle worker, sends it the path to infer and waits for
+    the answer. Workers that crash or time out are replaced by a new one.
+    Workers that cannot be restarted are started again in the background,
+    every retry_delay seconds until the pool is back to its size.
+    """
+
+    def __init__(self, model_spec, size=1, timeout=300, load_timeout=600, retry_delay=10):
+        self.model_spec = model_spec
+        self.size = size
+        self.timeout = timeout
+        self.load_timeout = load_timeout
+        self.retry_delay = retry_delay
+        self.refilling = False
+        self.closed = False
+        # spawn rather than fork: model frameworks (CUDA) do not survive a fork
+        self.context = multiprocessing.get_context("spawn")
+        self.idle = queue.Queue()
+        self.restarts = 0
+        self.lock = threading.Lock()
+        self.workers = []
+        for _ in range(size):
+            self._add_worker()
+        self.model_version = self.workers[0].model_version
+        print("%d model worker(s) loaded %s" % (size, model_spec))
+
+    def _add_worker(self):
+        worker = ModelWorker(self.context, self.model_spec, self.load_timeout)
+        with self.lock:
+            self.workers.append(worker)
+        self.idle.put(worker)
+
+    def _replace(self, worker):
+        """Stop a broken worker and start a new one in its place"""
+        print("Restarting model worker %d" % worker.process.pid)
+        worker.stop()
+        with self.lock:
+            self.workers.remove(worker)
+            self.restarts += 1
+        try:
+            self._add_worker()
+        except ModelWorkerError as e:
+            # The pool shrinks until the missing worker is started again
+            print("Could not restart model worker: %s" % e)
+            self._refill()
+
+    def _refill(self):
+        """Start the missing workers in a background thread, unless one already does"""
+        with self.lock:
+            if self.refilling or self.closed:
+                return
+            self.refilling = True
+        threading.Thread(target=self._refill_loop, name="model_worker_refill", daemon=True).start()
+
+    def _refill_loop(self):
+        try:
+            while True:
+                with self.lock:
+                    if self.closed or len(self.workers) >= self.size:
+                        return
+                try:
+                    self._add_worker()
+                    print("Model worker started, %d of %d running" % (len(self.workers), self.size))
+                except ModelWorkerError as e:
+                    print("Could not start model worker, retrying in %ss: %s" % (self.retry_delay, e))
+                    time.sleep(self.retry_delay)
+        finally:
+            with self.lock:
+                self.refilling = False
+
+    def infer(self, path):
+        """Run the model on the file at path and return its result dictionary"""
+        deadline = time.time() + self.timeout
+        while True:
+            # Without any worker, fail right away rather than wait for one to load
+            with self.lock:
+                if not self.workers:
+                    raise ModelWorkerError("No model worker running")
+            try:
+                worker = self.idle.get(timeout=max(0, min(1, deadline - time.time())))
+                break
+            except queue.Empty:
+                if time.time() >= deadline:
+                    raise ModelWorkerError("No model worker available")
+        try:
+            result = worker.call("infer", path, self.timeout)
+        except ModelWorkerLost:
+            # A late answer would be read by the next job, never reuse this worker
+            self._replace(worker)
+            raise
+        except ModelWorkerError:
+            self.idle.put(worker)
+            raise
+        self.idle.put(worker)
+        return result
+
+    def health(self):
+        """Check every idle worker answers, restart the crashed and missing ones and report the pool state"""
+        checked = []
+        for _ in range(self.idle.qsize()):
+            try:
+                worker = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                worker.call("ping", None, 5)
+                checked.append(worker)
+            except ModelWorkerError:
+                self._replace(worker)
+        for worker in checked:
+            self.idle.put(worker)
+        with self.lock:
+            missing = len(self.workers) < self.size
+        if missing:
+            self._refill()
+        with self.lock:
+            workers = [{"pid": w.process.pid, "alive": w.is_alive()} for w in self.workers]
+            refilling = self.refilling
+        return {
+            "mode": "worker",
+            "model": self.model_spec,
+            "model_version": self.model_version,
+            "workers": workers,
+            "idle": self.idle.qsize(),
+            "restarts": self.restarts,
+            "refilling": refilling,
+            "healthy": len(workers) == self.size and all(w["alive"] for w in workers),
+        }
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            workers, self.workers = self.workers, []
+        for worker in workers:
+            worker.stop()
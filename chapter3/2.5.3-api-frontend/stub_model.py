@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Stub model answering like run_demo.sh, to run the inference API without a GPU.
+
+    INFERENCE_MODE=worker INFERENCE_MODEL=stub_model:StubModel python3 inference-flask-api.py
+
+STUB_MODEL_LATENCY (seconds, default 0) simulates the inference time.
+"""
+
+import os
+import time
+import hashlib
+
+
+class StubModel():
+    version = "stub-0.0.1"
+
+    def __init__(self):
+        self.latency = float(os.environ.get("STUB_MODEL_LATENCY", "0"))
+
+    def predict(self, path):
+        """Return a fake but deterministic segmentation result for the file at path"""
+        with open(path, "rb") as f:
+            digest = hashlib.sha1(f.read()).hexdigest()
+        time.sleep(self.latency)
+        obj_count = int(digest[:2], 16) % 4
+        return {
+            "model_version": self.version,
+            "filename_seg": os.path.splitext(os.path.basename(path))[0] + "_seg.nrrd",
+            "obj_count": obj_count,
+            "result": [{"nodule": i, "score": int(digest[2 + 2 * i:4 + 2 * i], 16) / 255}
+                       for i in range(obj_count)],
+        }
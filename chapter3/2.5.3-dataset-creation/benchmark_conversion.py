@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compare the NRRD to DICOM conversion with fake metadata:
+
+  rewrite ..... former conversion: SimpleITK writes the DICOM, pydicom reads
+                it back, sets the patient tags and saves it again
+  single ...... create_dataset.transform(): the tags are set on the image and
+                SimpleITK writes the DICOM once
+
+Bytes read and written are the process I/O counters (/proc/self/io rchar and
+wchar), so they include reads served from the page cache. Without --nrrd, a
+synthetic CT-sized volume is generated.
+
+    python3 benchmark_conversion.py --shape 133,512,512 --repeat 3
+"""
+
+import os
+import time
+import argparse
+import tempfile
+import numpy as np
+import pydicom
+import SimpleITK as sitk
+
+import create_dataset
+
+
+def io_counters():
+    """Bytes read and written by this process so far (Linux)"""
+    counters = {}
+    with open("/proc/self/io") as io:
+        for line in io:
+            name, value = line.split(":")
+            counters[name] = int(value)
+    return counters["rchar"], counters["wchar"]
+
+
+def convert_rewrite(input_path, output_path, profile, age, sex):
+    """The former conversion: write, read back, set the tags and write again"""
+    img = sitk.Cast(sitk.ReadImage(input_path), sitk.sitkUInt16)
+    sitk.WriteImage(img, output_path)
+    dcm = pydicom.dcmread(output_path)
+    dcm.PatientID = profile["ssn"]
+    dcm.PatientName = profile["name"]
+    dcm.PatientAge = str(age)
+    dcm.PatientSex = str(sex)
+    dcm.save_as(output_path)
+
+
+def convert_single(input_path, output_path, profile, age, sex):
+    """The current conversion, a single write"""
+    create_dataset.nrrd2dcm(input_path, output_path, create_dataset.fake_metadata(profile, age, sex))
+
+
+def measure(convert, input_path, output_path, repeat):
+    """Return the best time, bytes read and bytes written of a conversion"""
+    profile = {"ssn": "123-45-6789", "name": "Jane Doe", "blood_group": "O+", "mail": "jane@example.com"}
+    best = None
+    for _ in range(repeat):
+        read_before, written_before = io_counters()
+        start = time.perf_counter()
+        convert(input_path, output_path, profile, 42, "F")
+        elapsed = time.perf_counter() - start
+        read_after, written_after = io_counters()
+        if best is None or elapsed < best[0]:
+            best = (elapsed, read_after - read_before, written_after - written_before)
+    dcm = pydicom.dcmread(output_path, stop_before_pixels=True)
+    assert (dcm.PatientID, str(dcm.PatientName), dcm.PatientAge, dcm.PatientSex) == \
+        ("123-45-6789", "Jane Doe", "42", "F"), convert.__name__
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--nrrd", help="volume to convert (default: a synthetic one)")
+    parser.add_argument("--shape", default="133,512,512", help="slices,rows,columns of the synthetic volume")
+    parser.add_argument("--repeat", type=int, default=3, help="conversions per method, the best is kept")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        input_path = args.nrrd
+        if not input_path:
+            input_path = os.path.join(workdir, "volume_CT.nrrd")
+            shape = [int(n) for n in args.shape.split(",")]
+            volume = np.random.RandomState(0).randint(-1024, 3000, size=shape).astype(np.int16)
+            sitk.WriteImage(sitk.GetImageFromArray(volume), input_path)
+        print("Volume %s (%.1f MB)" % (input_path, os.path.getsize(input_path) / 1024 / 1024))
+
+        results = {}
+        print("%-8s %9s %11s %14s" % ("method", "time (s)", "read (MB)", "written (MB)"))
+        for convert in (convert_rewrite, convert_single):
+            name = convert.__name__.split("_")[1]
+            output_path = os.path.join(workdir, name + ".dcm")
+            results[name] = measure(convert, input_path, output_path, args.repeat)
+            elapsed, read, written = results[name]
+            print("%-8s %9.3f %11.1f %14.1f" % (name, elapsed, read / 1024 / 1024, written / 1024 / 1024))
+        (t0, r0, w0), (t1, r1, w1) = results["rewrite"], results["single"]
+        print("Saved per volume: %.3fs (%.0f%%), %.1f MB read, %.1f MB written" % (
+            t0 - t1, 100 * (t0 - t1) / t0, (r0 - r1) / 1024 / 1024, (w0 - w1) / 1024 / 1024))
+
+
+if __name__ == "__main__":
+    main()
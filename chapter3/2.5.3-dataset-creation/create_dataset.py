@@ -2,13 +2,16 @@
 # -*- coding: utf-8 -*-
 
 import os
+import sys
 import glob
+import json
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import faker
 faker = faker.Faker()
 
 import pickle as pkl
-import pydicom
-from pydicom.datadict import DicomDictionary, keyword_dict
 import SimpleITK as sitk
 
 import numpy as np
@@ -19,33 +22,51 @@ import requests
 
 # Generate random metadata #####################################################
 
-def random_metadata(output_size):
+def random_metadata(output_size, seed=None, outlier=True):
+    random = np.random.RandomState(seed)
     # Age #####
     # random gaussian
-    age = np.random.randn(output_size) * 70 + 50
+    age = random.randn(output_size) * 70 + 50
     # clip values between 18 and 100, more or less
     age[age < 18] = abs(age[age < 18]) + 48
     age[age > 100] = age[age > 100] % 82 + 18
-    # add one outlier
-    age[513] = -5
+    # add one outlier (its position drawn anyway, to keep the next draws)
+    if output_size:
+        position = random.randint(output_size)
+        if outlier:
+            age[position] = -5
     age = age.astype(np.int8)
 
     # Sex #####
-    sex = np.random.choice(["M", "F"], size=output_size, p=[0.63, 0.37])
+    sex = random.choice(["M", "F"], size=output_size, p=[0.63, 0.37])
 
     # Smoking habits #####
     smoker = np.array([None] * output_size)
-    smoker[sex == "M"] = np.random.choice([True, False], size=np.sum(sex == "M"), p=[0.42, 0.58])
-    smoker[sex == "F"] = np.random.choice([True, False], size=np.sum(sex == "F"), p=[0.27, 0.73])
+    smoker[sex == "M"] = random.choice([True, False], size=np.sum(sex == "M"), p=[0.42, 0.58])
+    smoker[sex == "F"] = random.choice([True, False], size=np.sum(sex == "F"), p=[0.27, 0.73])
     return age, sex, smoker
 
 
+def random_profiles(output_size, seed=None, taken=()):
+    """Fake identities, the same ones for a given seed, with distinct SSNs not in taken"""
+    faker.seed_instance(seed)
+    ssns = set(taken)
+    profiles = []
+    while len(profiles) < output_size:
+        profile = faker.profile(fields=["ssn", "name", "blood_group", "mail"])
+        if profile["ssn"] not in ssns:
+            ssns.add(profile["ssn"])
+            profiles.append(profile)
+    return profiles
+
+
 # Convert NRRD to DICOM #########################################################
 
-def nrrd2dcm(input_path, output_path):
+def nrrd2dcm(input_path, output_path, tags=None):
     """
     Cast NRRD (in input_path) into DICOM (in output_path)
     Make sure the extensions are correct because type is automatically detected
+    tags ("gggg|eeee" -> value) are written in the DICOM header
     """
     assert(input_path.endswith(".nrrd"))
     assert(output_path.endswith(".dcm"))
@@ -56,57 +77,173 @@ def nrrd2dcm(input_path, output_path):
     castFilter = sitk.CastImageFilter()
     castFilter.SetOutputPixelType(sitk.sitkUInt16)
     img = castFilter.Execute(img)
+    for tag, value in (tags or {}).items():
+        img.SetMetaData(tag, value)
     # Save image
     sitk.WriteImage(img, output_path)
 
 
 
-# Replace metadatas with fake ones ##############################################
-# I couldn't manage to do it using SimpleITK, so I used pydicom to add them
+# Fake metadata #################################################################
+# The tags are set on the image before SimpleITK writes it, so the volume is
+# written once (see benchmark_conversion.py for the former pydicom rewrite)
+
+PATIENT_ID = "0010|0020"
+PATIENT_NAME = "0010|0010"
+PATIENT_AGE = "0010|1010"
+PATIENT_SEX = "0010|0040"
 
-def fake_metadata(input_path, age, sex, smoker, output_path):
+def fake_metadata(profile, age, sex):
     """
-    Replace metadata of the DICOM at path by fake ones:
-    PatientID, PatientName, PatientSex
+    DICOM tags of a fake patient:
+    PatientID, PatientName, PatientAge, PatientSex
     """
-    # load image and remove existing tags
-    img = pydicom.dcmread(input_path)
-    # for tag in img.dir():
-    #     del img[tag]
-    # add fake tags
-    # it's possible to add custom tags, see 
-    # https://pydicom.github.io/pydicom/stable/auto_examples/metadata_processing/plot_add_dict_entries.html
-    profile = faker.profile()
-    img.PatientID = profile["ssn"]
-    img.PatientName = profile["name"]
-    img.PatientAge = str(age)
-    img.PatientSex = str(sex)
-    print("%s,%s,%s,%s,%s,%s,%s" % (
-        profile["ssn"],profile["name"],profile["blood_group"],
-        profile["mail"],age,sex,smoker))
-    # save image
-    img.save_as(output_path)
-
-
+    return {
+        PATIENT_ID: profile["ssn"],
+        PATIENT_NAME: profile["name"],
+        PATIENT_AGE: str(age),
+        PATIENT_SEX: str(sex),
+    }
 
 
-def transform(input_path, age, sex, smoker):
-    # print(os.path.basename(input_path))
-    output_path = os.path.join("/wmlce/data/data/LIDC-DICOM", os.path.splitext(os.path.basename(input_path))[0] + ".dcm")
-    nrrd2dcm(input_path, output_path) # NRRD to DICOM
-    fake_metadata(output_path, age, sex, smoker, output_path) # overwrite existing image
+def patient_line(profile, age, sex, smoker):
+    """CSV line of a fake patient"""
+    return "%s,%s,%s,%s,%s,%s,%s" % (
+        profile["ssn"],profile["name"],profile["blood_group"],
+        profile["mail"],age,sex,smoker)
+
+
+def transform(input_path, output_path, patient):
+    """Convert a NRRD to DICOM with the fake patient metadata, return the manifest entry of the volume"""
+    stat = os.stat(input_path)
+    nrrd2dcm(input_path, output_path, fake_metadata(patient, patient["age"], patient["sex"])) # NRRD to DICOM
+    return {
+        "input": input_path,
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "output": output_path,
+        "sha256": file_sha256(output_path),
+        "patient": patient,
+    }
+
+
+def transform_safe(args):
+    """transform() for the process pool: return (manifest entry, None) or (None, error)"""
+    try:
+        return transform(*args), None
+    except Exception as e:
+        return None, "%s: %s" % (args[0], e)
+
+
+# Manifest #####################################################################
+# One JSON line per converted volume, appended as soon as it is done: after a
+# crash, a rerun only converts the volumes missing from the manifest and the
+# new or changed NRRD. A volume keeps its fake patient across reruns.
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def read_manifest(manifest_path):
+    """Return the manifest entries by input path, the last entry of an input wins"""
+    entries = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as manifest:
+            for line in manifest:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # line cut by a crash
+                    continue
+                entries[entry["input"]] = entry
+    return entries
+
+
+def write_manifest(manifest_path, entries):
+    """Rewrite the manifest with entries only"""
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w") as manifest:
+        for entry in entries:
+            manifest.write(json.dumps(entry) + "\n")
+    os.replace(tmp_path, manifest_path)
+
+
+def up_to_date(entry, input_path, verify=False):
+    """Whether the output of a manifest entry matches the input as it is now"""
+    try:
+        stat = os.stat(input_path)
+        if (entry["size"], entry["mtime"]) != (stat.st_size, stat.st_mtime) or not os.path.exists(entry["output"]):
+            return False
+    except OSError:
+        return False
+    return not verify or file_sha256(entry["output"]) == entry["sha256"]
 
 
 
 if __name__=="__main__":
-    input_dir = "/wmlce/data/data/LIDC-IDRI/"
-    nrrd_paths = sorted(glob.glob(input_dir + "**/*_CT.nrrd", recursive=True))
-    age, sex, smoker = random_metadata(len(nrrd_paths))
-    print("ssn,name,address,blood_group,mail,age,sex,smoker")
-    for i, nrrd in enumerate(nrrd_paths):
-        # print("[",i+1,"/",len(nrrd_paths),"]",sep="")
-        transform(nrrd, age[i], sex[i], smoker[i])
-
-
-
-
+    parser = argparse.ArgumentParser(description="Convert the LIDC-IDRI NRRD to DICOM with fake patient metadata, "
+                                     "and write the patients CSV")
+    parser.add_argument("--input-dir", default="/wmlce/data/data/LIDC-IDRI/", help="where to look for *_CT.nrrd")
+    parser.add_argument("--output-dir", default="/wmlce/data/data/LIDC-DICOM", help="where to write the DICOM")
+    parser.add_argument("--manifest", help="manifest of the converted volumes (default: OUTPUT_DIR/manifest.jsonl)")
+    parser.add_argument("--csv", help="patients CSV to write (default: standard output)")
+    parser.add_argument("--verify", action="store_true", help="check the checksum of the already converted DICOM")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="conversion processes")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the fake metadata")
+    args = parser.parse_args()
+
+    manifest_path = args.manifest or os.path.join(args.output_dir, "manifest.jsonl")
+    os.makedirs(args.output_dir, exist_ok=True)
+    nrrd_paths = sorted(glob.glob(os.path.join(args.input_dir, "**/*_CT.nrrd"), recursive=True))
+    entries = read_manifest(manifest_path)
+    # Metadata is drawn up front: the same seed gives the same patients whatever
+    # the number of workers. Volumes of the manifest keep their patient, and the
+    # new ones get the metadata drawn at their position in the file list, and
+    # identities drawn in file order, never with an SSN already given to a
+    # volume of the manifest. The age outlier is only added by the first run.
+    new_paths = [nrrd for nrrd in nrrd_paths if nrrd not in entries]
+    age, sex, smoker = random_metadata(len(nrrd_paths), args.seed, outlier=not entries)
+    metadata = {nrrd: (int(a), str(x), bool(y)) for nrrd, a, x, y in zip(nrrd_paths, age, sex, smoker)}
+    profiles = random_profiles(len(new_paths), args.seed, {entry["patient"]["ssn"] for entry in entries.values()})
+    new_patients = {nrrd: dict(profile, age=metadata[nrrd][0], sex=metadata[nrrd][1], smoker=metadata[nrrd][2])
+                    for nrrd, profile in zip(new_paths, profiles)}
+    jobs = []
+    for nrrd in nrrd_paths:
+        entry = entries.get(nrrd)
+        if entry and up_to_date(entry, nrrd, args.verify):
+            continue
+        # A changed volume keeps the patient it was given
+        patient = entry["patient"] if entry else new_patients[nrrd]
+        output_path = os.path.join(args.output_dir, os.path.splitext(os.path.basename(nrrd))[0] + ".dcm")
+        jobs.append((nrrd, output_path, patient))
+    print("%d volumes, %d to convert" % (len(nrrd_paths), len(jobs)), file=sys.stderr)
+
+    failures = 0
+    with open(manifest_path, "a") as manifest, ProcessPoolExecutor(max_workers=args.workers) as executor:
+        for future in as_completed([executor.submit(transform_safe, job) for job in jobs]):
+            entry, error = future.result()
+            if error:
+                failures += 1
+                print(error, file=sys.stderr)
+                continue
+            entries[entry["input"]] = entry
+            manifest.write(json.dumps(entry) + "\n")
+            manifest.flush()
+
+    # Compact the manifest to the current volumes, and write the CSV from it
+    # in file order
+    done = [entries[nrrd] for nrrd in nrrd_paths if nrrd in entries and up_to_date(entries[nrrd], nrrd)]
+    write_manifest(manifest_path, done)
+    csv = open(args.csv, "w") if args.csv else sys.stdout
+    csv.write("ssn,name,blood_group,mail,age,sex,smoker\n")
+    for entry in done:
+        patient = entry["patient"]
+        csv.write(patient_line(patient, patient["age"], patient["sex"], patient["smoker"]) + "\n")
+    if args.csv:
+        csv.close()
+    if failures:
+        raise SystemExit("%d of %d files failed" % (failures, len(jobs)))
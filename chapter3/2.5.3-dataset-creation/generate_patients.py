@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Generate synthetic patients (ssn, name, blood group, email, age, sex,
+smoker), millions at a time, for load tests of the db agent and of the
+dataset insights.
+
+Every column is drawn with vectorized NumPy sampling: names are picked from
+pools drawn once from faker, SSNs are unique, and a fraction of the ages are
+replaced by outliers. The same seed gives the same patients, whatever the
+--batch-size: random values are drawn per block of BLOCK rows.
+
+Formats:
+    csv ....... the patient database of the db agent (client_database.csv)
+    npz ....... one array per column
+    records ... JSON list of Discover records of the patients' DICOM, for
+                common/discover_stub_server.py --records
+
+    python3 generate_patients.py --rows 1000000 --format csv --output client_database.csv
+"""
+
+import sys
+import json
+import argparse
+import numpy as np
+import faker
+
+FIELDS = ("ssn", "name", "blood_group", "mail", "age", "sex", "smoker")
+
+BLOOD_GROUPS = ["O+", "A+", "B+", "AB+", "O-", "A-", "B-", "AB-"]
+BLOOD_GROUP_P = [0.374, 0.357, 0.085, 0.034, 0.066, 0.063, 0.015, 0.006]
+
+# Rows of a random stream: batches are cut from whole blocks
+BLOCK = 65536
+
+
+def name_pools(seed, size=1000):
+    """First names, last names and mail domains drawn from faker"""
+    fake = faker.Faker()
+    fake.seed_instance(seed)
+    first = np.array(sorted({fake.first_name() for _ in range(size)}))
+    last = np.array(sorted({fake.last_name() for _ in range(size)}))
+    domains = np.array(sorted({fake.free_email_domain() for _ in range(50)}))
+    return first, last, domains
+
+
+def unique_ssns(rows, seed=0):
+    """rows distinct SSNs, as integers"""
+    return np.random.default_rng([seed]).choice(10**9, size=rows, replace=False)
+
+
+def draw(seed, block, outlier_rate, pools):
+    """Return a dict of the random columns of the BLOCK rows of block number block"""
+    rng = np.random.default_rng([seed, block, 1])
+    first, last, domains = pools
+
+    columns = {
+        "first": rng.integers(len(first), size=BLOCK),
+        "last": rng.integers(len(last), size=BLOCK),
+        "domain": rng.integers(len(domains), size=BLOCK),
+        "blood_group": rng.choice(len(BLOOD_GROUPS), size=BLOCK, p=BLOOD_GROUP_P),
+    }
+
+    # Same distributions as create_dataset.random_metadata()
+    age = rng.standard_normal(BLOCK) * 70 + 50
+    age[age < 18] = abs(age[age < 18]) + 48
+    age[age > 100] = age[age > 100] % 82 + 18
+    age = age.astype(np.int16)
+    outliers = rng.random(BLOCK) < outlier_rate
+    age[outliers] = rng.choice([-5, -1, 0, 130, 150], size=outliers.sum())
+    columns["age"] = age
+
+    columns["sex"] = np.where(rng.random(BLOCK) < 0.63, "M", "F")
+    columns["smoker"] = rng.random(BLOCK) < np.where(columns["sex"] == "M", 0.42, 0.27)
+    return columns
+
+
+def generate(ssn, seed=0, outlier_rate=0.001, start=0, pools=None):
+    """Return a dict of arrays of the patients of the integer SSNs ssn
+
+    start is the row number of the first patient: its random values are
+    taken from the blocks of rows start to start + len(ssn), and it makes
+    the mails unique across batches.
+    """
+    rows = len(ssn)
+    first, last, domains = pools = pools or name_pools(seed)
+    first_block = start // BLOCK
+    blocks = [draw(seed, block, outlier_rate, pools)
+              for block in range(first_block, (start + rows - 1) // BLOCK + 1)]
+    offset = start - first_block * BLOCK
+    random = {name: np.concatenate([block[name] for block in blocks])[offset:offset + rows]
+              for name in blocks[0]}
+
+    # Formatted ddd-dd-dddd
+    ssn = np.char.add(np.char.add(np.char.add(np.char.add(
+        np.char.zfill((ssn // 10**6).astype("U3"), 3), "-"),
+        np.char.zfill((ssn // 10**4 % 100).astype("U2"), 2)), "-"),
+        np.char.zfill((ssn % 10**4).astype("U4"), 4))
+
+    first_names = first[random["first"]]
+    last_names = last[random["last"]]
+    name = np.char.add(np.char.add(first_names, " "), last_names)
+    # Unique mails: the row number disambiguates namesakes
+    mail = np.char.add(np.char.add(np.char.add(np.char.add(np.char.add(
+        np.char.lower(first_names), "."), np.char.lower(last_names)),
+        np.arange(start, start + rows).astype("U")), "@"), domains[random["domain"]])
+    mail = np.char.replace(np.char.replace(mail, " ", ""), "'", "")
+
+    blood_group = np.array(BLOOD_GROUPS)[random["blood_group"]]
+
+    return {"ssn": ssn, "name": name, "blood_group": blood_group, "mail": mail,
+            "age": random["age"], "sex": random["sex"], "smoker": random["smoker"]}
+
+
+def batches(rows, batch_size, seed=0, outlier_rate=0.001):
+    """Yield the first row number and the patients of batches of batch_size rows"""
+    pools = name_pools(seed)
+    ssns = unique_ssns(rows, seed)
+    for start in range(0, rows, batch_size):
+        yield start, generate(ssns[start:start + batch_size], seed, outlier_rate, start, pools)
+
+
+def write_csv(out, patients):
+    smoker = np.where(patients["smoker"], "True", "False")
+    for row in zip(patients["ssn"], patients["name"], patients["blood_group"], patients["mail"],
+                   patients["age"], patients["sex"], smoker):
+        out.write("%s,%s,%s,%s,%d,%s,%s\n" % row)
+
+
+def write_records(out, patients, start, first):
+    """Write the patients as Discover records of their DICOM (dicom_* metadata)"""
+    for i, (ssn, age, sex, smoker) in enumerate(zip(patients["ssn"], patients["age"], patients["sex"],
+                                                    patients["smoker"])):
+        record = {
+            "fkey": "dataset%d" % (start + i),
+            "path": "/export/lidcdata/dataset/LIDC-IDRI-%07d_CT.dcm" % (start + i),
+            "mtime": "2019-10-01 00:00:00",
+            "dicom_pid": str(ssn),
+            "dicom_page": str(age),
+            "dicom_psex": str(sex),
+            "dicom_smoker": str(bool(smoker)),
+        }
+        out.write(("" if first and i == 0 else ",\n") + json.dumps(record))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1000000, help="number of patients")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--outlier-rate", type=float, default=0.001, help="fraction of out of range ages")
+    parser.add_argument("--format", choices=["csv", "npz", "records"], default="csv")
+    parser.add_argument("--output", help="output file (default: standard output, not for npz)")
+    parser.add_argument("--batch-size", type=int, default=1000000, help="rows generated at once")
+    args = parser.parse_args()
+
+    if args.format == "npz":
+        if not args.output:
+            raise SystemExit("--output is required for npz")
+        parts = [patients for _, patients in batches(args.rows, args.batch_size, args.seed, args.outlier_rate)]
+        np.savez(args.output, **{name: np.concatenate([part[name] for part in parts]) for name in FIELDS})
+        return
+
+    out = open(args.output, "w") if args.output else sys.stdout
+    if args.format == "csv":
+        out.write(",".join(FIELDS) + "\n")
+    else:
+        out.write("[")
+    for start, patients in batches(args.rows, args.batch_size, args.seed, args.outlier_rate):
+        if args.format == "csv":
+            write_csv(out, patients)
+        else:
+            write_records(out, patients, start, start == 0)
+    if args.format == "records":
+        out.write("]\n")
+    if args.output:
+        out.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+On-disk columnar snapshot of search results.
+
+A snapshot is a directory holding one .npy file per column and a meta.json,
+named after a hash of the query so each query has its own snapshot. Columns
+are loaded memory mapped: opening a snapshot does not read it.
+"""
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class ColumnSnapshot():
+    """The snapshot of the results of a query, under directory"""
+
+    def __init__(self, directory, query):
+        self.query = query
+        self.path = os.path.join(directory, hashlib.sha1(query.encode("utf-8")).hexdigest()[:16])
+        self.meta = None
+
+    def load(self):
+        """Return the columns of the snapshot as memory mapped arrays, or None if there is none"""
+        try:
+            with open(os.path.join(self.path, "meta.json")) as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            return None
+        if meta["query"] != self.query:
+            logger.warning("Snapshot %s is for another query, ignoring it", self.path)
+            return None
+        self.meta = meta
+        return {name: np.load(os.path.join(self.path, name + ".npy"), mmap_mode="r")
+                for name in meta["columns"]}
+
+    def save(self, columns, **meta):
+        """Replace the snapshot by columns, a dict of arrays, with extra meta data
+
+        The new snapshot is written aside and swapped in, so a failed save
+        leaves the previous snapshot untouched.
+        """
+        tmp_path = "%s.tmp-%d" % (self.path, os.getpid())
+        old_path = "%s.old-%d" % (self.path, os.getpid())
+        os.makedirs(tmp_path)
+        try:
+            for name, column in columns.items():
+                np.save(os.path.join(tmp_path, name + ".npy"), np.ascontiguousarray(column))
+            meta = dict(meta, query=self.query, columns=list(columns),
+                        rows=len(next(iter(columns.values()), [])), saved=time.time())
+            with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+                json.dump(meta, f)
+            if os.path.exists(self.path):
+                os.rename(self.path, old_path)
+            try:
+                os.rename(tmp_path, self.path)
+            except OSError:
+                if os.path.exists(old_path):
+                    os.rename(old_path, self.path)
+                raise
+        finally:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        # Only once the new snapshot is in place
+        shutil.rmtree(old_path, ignore_errors=True)
+        self.meta = meta
+        logger.info("Snapshot %s saved: %d rows", self.path, meta["rows"])
+
+
+def merge(columns, updates, key="fkey"):
+    """Return columns with the rows of updates added, replacing the rows with the same key"""
+    keep = ~np.isin(columns[key], updates[key])
+    return {name: np.concatenate([columns[name][keep], updates[name]]) for name in columns}
+
+
+def contains(columns, updates, key="fkey"):
+    """Return whether every row of updates is already in columns, with the same values"""
+    keys = columns[key]
+    if not len(keys):
+        return not len(updates[key])
+    order = np.argsort(keys)
+    rows = order[np.minimum(np.searchsorted(keys, updates[key], sorter=order), len(keys) - 1)]
+    return all(np.array_equal(columns[name][rows], updates[name]) for name in columns)
@@ -5,113 +5,214 @@ import numpy as np
 import pandas as pd
 import seaborn as sns
 import matplotlib.pyplot as plt
-import requests
-import json
 import logging
 import os
+import sys
+import hashlib
 # logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
-from urllib.parse import urljoin
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from discover_client import DiscoverClient, DiscoverError, quote
+from column_snapshot import ColumnSnapshot, contains, merge
 
 SD_HOST = os.environ["SD_HOST"]
 SD_USER = os.environ["SD_USER"]
 SD_PASSWORD = os.environ["SD_PASSWORD"]
+# Rows per search request, and pages requested ahead while one is converted
+SD_PAGE_SIZE = int(os.environ.get("SD_PAGE_SIZE", "10000"))
+SD_PREFETCH = int(os.environ.get("SD_PREFETCH", "2"))
+# "aggregate" has Discover count the records per sex, smoker and age
+# (group_by) instead of downloading them, "rows" downloads every record
+SD_QUERY_MODE = os.environ.get("SD_QUERY_MODE", "aggregate")
+# Downloaded records are kept in a snapshot under SD_SNAPSHOT_DIR (empty to
+# disable). SD_SNAPSHOT_REFRESH: "incremental" fetches the records modified
+# since the snapshot, "full" downloads everything again (records deleted from
+# Discover are only dropped then), "none" plots the snapshot as is, offline.
+SD_SNAPSHOT_DIR = os.environ.get("SD_SNAPSHOT_DIR", "snapshots")
+SD_SNAPSHOT_REFRESH = os.environ.get("SD_SNAPSHOT_REFRESH", "incremental")
 
-def get_token():
-    global SD_HOST
-    global SD_USER
-    global SD_PASSWORD
-    headers = {}
-    basic_auth = requests.auth.HTTPBasicAuth(SD_USER, SD_PASSWORD)
-    identity_auth_url=urljoin(SD_HOST,"/auth/v1/token")
-    logger.debug("Getting a new token for %s:%s on %s" % (SD_USER,SD_PASSWORD,SD_HOST))
-    try:
-        response = requests.get(identity_auth_url, verify=False, headers=headers, auth=basic_auth)
-        # check response from identity auth server
-        if response.status_code == 200:
-            application_token = response.headers['X-Auth-Token']
-            return application_token
-        raise Exception("Attempt to obtain token returned (%d)" % response.status_code)
-    except Exception as exc:
-        logger.error('Application failed to obtain token (%s)', str(exc))
-        raise
-    return
-
-
-def get_discover_data():
-    global SD_TOKEN
-    global SD_HOST
-    headers = {
-        'Content-Type': 'application/json',
-        'Authorization': 'Bearer %s' % SD_TOKEN if SD_TOKEN else ""
-    }
+DATASET_QUERY = "path like '/export/lidcdata/dataset%'"
+
+# Records are counted per sex and 6-year age interval, and plotted from the counts
+SEXES = ("M", "F")
+AGE_BINS = np.arange(0, 126, 6)
+
+# Columns extracted from the search rows: name -> (dtype, value of a row)
+COLUMNS = {
+    "age": (np.int16, lambda row: int(row["dicom_page"])),
+    "sex": ("U1", lambda row: row["dicom_psex"]),
+    "smoker": (bool, lambda row: row["dicom_smoker"] == "True"),
+}
+
+
+def fkey_hash(fkey):
+    """64-bit hash of a record fkey, to key snapshot rows without storing the strings"""
+    return int.from_bytes(hashlib.blake2b(fkey.encode("utf-8"), digest_size=8).digest(), "little", signed=True)
+
+
+SNAPSHOT_COLUMNS = dict(COLUMNS, fkey=(np.int64, lambda row: fkey_hash(row["fkey"])))
+
+
+def fetch_columns(discover, query, columns, page_size=SD_PAGE_SIZE, prefetch=SD_PREFETCH):
+    """Search records and return their columns as arrays, and the latest mtime of the records
+
+    Results are fetched page by page and each page is converted to typed
+    arrays right away, so only one page of rows is held as dicts at a time.
+    """
     json_query = {
-        "query":"path like '/export/lidcdata/dataset%'",
+        "query":query,
         "filters":[],
         "group_by":[],
         "sort_by":[],
-        # "limit":3
     }
-    query_url=urljoin(SD_HOST,"/db2whrest/v1/search")
-    try:
-        response = requests.post(url=query_url, verify=False, json=json_query, headers=headers, auth=None)
-        if response.status_code == 401:
-            logger.debug("A new token is required")
-            SD_TOKEN = get_token()
-            logger.debug("New token is %s"%SD_TOKEN)
-            headers = {
-                'Content-Type': 'application/json',
-                'Authorization': 'Bearer %s' % SD_TOKEN
-            }
-            response = requests.post(url=query_url, verify=False, json=json_query, headers=headers, auth=None)
-        if response.status_code == 200:
-            return json.loads(response.json()["rows"])
-        raise Exception("Metadata failed with code %d" % response.status_code)
-    except Exception as exc:
-        logger.error('Application failed to obtain token (%s)', str(exc))
-        raise
+    chunks = {name: [] for name in columns}
+    latest = None
+    for rows in discover.search_pages(json_query, page_size, prefetch):
+        for name, (dtype, value) in columns.items():
+            chunks[name].append(np.fromiter((value(row) for row in rows), dtype=dtype, count=len(rows)))
+        mtimes = [str(row["mtime"]) for row in rows if row.get("mtime")]
+        if mtimes:
+            latest = max(mtimes + [latest] if latest else mtimes)
+        logger.debug("%d rows fetched", len(rows))
+    return {name: np.concatenate(chunks[name]) if chunks[name] else np.array([], dtype=dtype)
+            for name, (dtype, _) in columns.items()}, latest
+
+
+def get_discover_data(discover):
+    """Search the dataset records and return their COLUMNS as arrays"""
+    return fetch_columns(discover, DATASET_QUERY, COLUMNS)[0]
+
+
+def get_snapshot_data(discover, directory=SD_SNAPSHOT_DIR, refresh=SD_SNAPSHOT_REFRESH):
+    """Return the COLUMNS of the dataset records from the local snapshot, refreshing it first
+
+    Columns are memory mapped from the snapshot. An incremental refresh only
+    downloads the records with an mtime from the latest one of the snapshot
+    (included: records modified in the same second are fetched again and
+    replace their previous version, matched by fkey).
+    """
+    snapshot = ColumnSnapshot(directory, DATASET_QUERY)
+    data = snapshot.load()
+    if data is None or refresh == "full" or (refresh == "incremental" and not snapshot.meta["latest_mtime"]):
+        logger.info("Downloading the dataset records into snapshot %s", snapshot.path)
+        data, latest = fetch_columns(discover, DATASET_QUERY, SNAPSHOT_COLUMNS)
+        snapshot.save(data, latest_mtime=latest)
+        data = snapshot.load()
+    elif refresh == "incremental":
+        query = "(%s) AND mtime >= %s" % (DATASET_QUERY, quote(snapshot.meta["latest_mtime"]))
+        updates, latest = fetch_columns(discover, query, SNAPSHOT_COLUMNS)
+        logger.info("%d records modified since %s", len(updates["fkey"]), snapshot.meta["latest_mtime"])
+        # Records of the latest second are fetched again on every refresh
+        if not contains(data, updates):
+            snapshot.save(merge(data, updates), latest_mtime=max(latest, snapshot.meta["latest_mtime"]))
+            data = snapshot.load()
+    return {name: data[name] for name in COLUMNS}
+
+
+def count_groups(age, sex, smoker, count=None):
+    """Count records per sex, smoker and age bucket
+
+    Returns a counts[sex, smoker, bucket] array, indexed by SEXES, smoker
+    (False, True) and the intervals of AGE_BINS, the last one including its
+    upper bound. Ages outside the bins (outliers such as -5 or 150) are not
+    counted. count holds the number of records of each row, 1 when None.
+    """
+    buckets = len(AGE_BINS) - 1
+    inside = (age >= AGE_BINS[0]) & (age <= AGE_BINS[-1])
+    bucket = np.minimum(np.digitize(age, AGE_BINS) - 1, buckets - 1)
+    group = smoker.astype(np.int64) * buckets + bucket
+    counts = np.zeros((len(SEXES), 2, buckets), dtype=np.int64)
+    for i, value in enumerate(SEXES):
+        selected = (sex == value) & inside
+        weights = None if count is None else count[selected]
+        counts[i] = np.bincount(group[selected], weights=weights, minlength=2 * buckets).reshape(2, buckets)
+    return counts
+
+
+def get_discover_counts(discover):
+    """Count the dataset records per sex, smoker and age bucket on Discover, see count_groups()
+
+    Discover answers one row per sex, smoker and age with its count, a few
+    hundred rows whatever the number of records (group_by takes fields, not
+    buckets), which are summed into the age buckets.
+    Raises ValueError if Discover does not answer counts.
+    """
+    json_query = {
+        "query":DATASET_QUERY,
+        "filters":[],
+        "group_by":["dicom_psex", "dicom_smoker", "dicom_page"],
+        "sort_by":[],
+    }
+    groups = discover.search(json_query)
+    if groups and "count" not in groups[0]:
+        raise ValueError("search did not answer group counts")
+    count = np.fromiter((int(group["count"]) for group in groups), dtype=np.int64, count=len(groups))
+    logger.info("%d groups counting %d records", len(groups), count.sum())
+    columns = {name: np.fromiter((value(group) for group in groups), dtype=dtype, count=len(groups))
+               for name, (dtype, value) in COLUMNS.items()}
+    return count_groups(columns["age"], columns["sex"], columns["smoker"], count)
 
 
 # Plots ########################################################################
-def plot(age, sex, smoker):
+def box_stats(counts, label):
+    """Box plot statistics of the ages counted per AGE_BINS interval
+
+    Quartiles are interpolated within their bucket, whiskers reach the
+    counted ages up to 1.5 times the interquartile range from the box.
+    """
+    cumulative = np.concatenate([[0], np.cumsum(counts)])
+    q1, median, q3 = np.interp(np.array([0.25, 0.5, 0.75]) * cumulative[-1], cumulative, AGE_BINS)
+    counted = np.flatnonzero(counts)
+    lowest, highest = AGE_BINS[counted[0]], AGE_BINS[counted[-1] + 1]
+    iqr = q3 - q1
+    return {"label": label, "q1": q1, "med": median, "q3": q3, "fliers": [],
+            "whislo": max(lowest, q1 - 1.5 * iqr), "whishi": min(highest, q3 + 1.5 * iqr)}
+
+
+def plot(counts):
+    """Plot the counts[sex, smoker, bucket] of count_groups()"""
     sns.set()
+    ages = counts.sum(axis=1)
 
     # Ages histogram
-    bins = np.linspace(0, 120, 20)
-    sns.distplot(age[sex == "M"], color="blue", bins=bins)
-    sns.distplot(age[sex == "F"], color="red", bins=bins)
+    plt.figure()
+    for i, color in enumerate(("blue", "red")):
+        plt.hist(AGE_BINS[:-1], bins=AGE_BINS, weights=ages[i], density=True, color=color, alpha=0.4)
     plt.xlabel("Patients age (6-year intervals)")
     plt.ylabel("Proportion of each age interval")
     plt.yticks([])
     plt.legend(labels=["Male", "Female"])
     plt.savefig("plot-ages_histogram.png")
 
-    # Ages catplot
-    plt.clf()
-    sns.catplot(x="sex", y="age", kind="box", data=pd.DataFrame({"age": age, "sex": sex}))
+    # Ages box plot
+    plt.figure()
+    plt.gca().bxp([box_stats(ages[i], value) for i, value in enumerate(SEXES) if ages[i].any()])
+    plt.xlabel("sex")
+    plt.ylabel("age")
     plt.savefig("plot-ages_catplot.png")
 
     # Smokers stats plots
-    m_smokers = dict(np.array(np.unique(smoker[sex == "M"], return_counts=True)).T) 
-    f_smokers = dict(np.array(np.unique(smoker[sex == "F"], return_counts=True)).T) 
-    smokers_data = pd.DataFrame([[m_smokers[True], m_smokers[False]], [f_smokers[True], f_smokers[False]]],
-            columns=["Smoker", "No smoker"], index=["Male", "Female"])
-
+    plt.figure()
+    smokers = counts.sum(axis=2)
+    smokers_data = pd.DataFrame(smokers[:, ::-1], columns=["Smoker", "No smoker"], index=["Male", "Female"])
     sns.heatmap(smokers_data, square=True, annot=True, cbar=False, cmap='Blues', fmt='g')
     plt.savefig("plot-smokers_heatmap.png")
 
 if __name__=="__main__":
-    SD_TOKEN = get_token()
-
-    age, sex, smoker = [], [], []
-    for l in get_discover_data():
-        age.append(int(l["dicom_page"]))
-        sex.append(l["dicom_psex"])
-        smoker.append(l["dicom_smoker"] == "True")
-    age = np.array(age)
-    sex = np.array(sex)
-    smoker = np.array(smoker)
-
-    plot(age, sex, smoker)
+    discover = DiscoverClient.from_env(SD_HOST, SD_USER, SD_PASSWORD)
+
+    data = None
+    if SD_QUERY_MODE == "aggregate":
+        try:
+            data = get_discover_counts(discover)
+        except (DiscoverError, KeyError, ValueError) as exc:
+            logger.warning("Aggregation failed (%s), downloading the records", str(exc))
+    if data is None:
+        columns = get_snapshot_data(discover) if SD_SNAPSHOT_DIR else get_discover_data(discover)
+        data = count_groups(columns["age"], columns["sex"], columns["smoker"])
+
+    if not data.any():
+        raise SystemExit("No dataset record with an age within %d-%d to plot" % (AGE_BINS[0], AGE_BINS[-1]))
+    plot(data)
 
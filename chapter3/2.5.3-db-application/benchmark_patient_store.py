@@ -0,0 +1,116 @@
+#!/usr/bin/python -W ignore
+########################################################## {COPYRIGHT-TOP} ###
+# Licensed Materials - Property of IBM
+# 5737-I32
+#
+# (C) Copyright IBM Corp. 2019
+#
+# US Government Users Restricted Rights - Use, duplication, or
+# disclosure restricted by GSA ADP Schedule Contract with IBM Corp.
+########################################################## {COPYRIGHT-END} ###
+"""Compare the patient store backends: load time, memory and lookup latency.
+
+Each backend is measured in its own process so that memory figures do not
+mix. Without --csv, a synthetic database of --rows patients is generated.
+
+    python3 benchmark_patient_store.py --rows 1000000
+"""
+
+import os
+import csv
+import time
+import random
+import argparse
+import tempfile
+import multiprocessing
+
+from patient_store import BACKENDS, SQLitePatientStore, open_patient_store, read_patients
+
+def rss_mb():
+    """Current resident set size of this process, in MB (Linux)"""
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+
+def generate_csv(path, rows, seed=0):
+    """Write a synthetic patient database of rows patients"""
+    rng = random.Random(seed)
+    ssns = rng.sample(range(1000000000), rows)
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["ssn", "name", "blood_group", "mail", "age", "sex", "smoker"])
+        for i, ssn in enumerate(ssns):
+            ssn = "%09d" % ssn
+            writer.writerow(["%s-%s-%s" % (ssn[:3], ssn[3:5], ssn[5:]),
+                             "Patient %d" % i,
+                             rng.choice(["A+", "A-", "B+", "B-", "AB+", "AB-", "O+", "O-"]),
+                             "patient%d@example.com" % i,
+                             rng.randint(18, 100),
+                             rng.choice("MF"),
+                             rng.choice(["True", "False"])])
+
+def measure(backend, csvdb, index_path, ssns, queue):
+    """Open the store with a backend and measure it, in a child process"""
+    rss_before = rss_mb()
+    start = time.perf_counter()
+    if backend == "sqlite":
+        store = SQLitePatientStore(csvdb, index_path)
+    else:
+        store = open_patient_store(csvdb, backend)
+    load_time = time.perf_counter() - start
+    rss_loaded = rss_mb() - rss_before
+
+    latencies = []
+    for ssn in ssns:
+        start = time.perf_counter()
+        found = store.get(ssn)
+        latencies.append(time.perf_counter() - start)
+        assert found, ssn
+    latencies.sort()
+    queue.put((backend, load_time, rss_loaded, rss_mb() - rss_before,
+               latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)]))
+    store.close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--csv", help="patient database to load (default: a synthetic one)")
+    parser.add_argument("--rows", type=int, default=1000000, help="patients of the synthetic database")
+    parser.add_argument("--lookups", type=int, default=10000, help="random lookups per backend")
+    parser.add_argument("--backends", default=",".join(BACKENDS), help="comma separated backends")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        csvdb = args.csv
+        if not csvdb:
+            csvdb = os.path.join(workdir, "client_database.csv")
+            print("Generating %d patients in %s" % (args.rows, csvdb))
+            generate_csv(csvdb, args.rows)
+
+        ssns = [client[0] for client in read_patients(csvdb)]
+        ssns = random.Random(1).choices(ssns, k=args.lookups)
+
+        # The SQLite index is built once, ahead of time (as in the image build):
+        # its build time is reported apart from the load time. It is built in
+        # the work directory, never over the index of a --csv database.
+        index_path = os.path.join(workdir, "client_database.db")
+        if "sqlite" in args.backends.split(","):
+            start = time.perf_counter()
+            SQLitePatientStore.build(csvdb, index_path)
+            print("SQLite index built in %.1fs (%.0f MB on disk)" % (
+                time.perf_counter() - start, os.path.getsize(index_path) / 1024 / 1024))
+
+        print("%-8s %10s %14s %14s %12s %12s" % (
+            "backend", "load (s)", "RSS load (MB)", "RSS total (MB)", "p50 (us)", "p99 (us)"))
+        queue = multiprocessing.Queue()
+        for backend in args.backends.split(","):
+            process = multiprocessing.Process(target=measure, args=(backend, csvdb, index_path, ssns, queue))
+            process.start()
+            process.join()
+            if process.exitcode:
+                print("%-8s failed" % backend)
+                continue
+            name, load_time, rss_loaded, rss_total, p50, p99 = queue.get()
+            print("%-8s %10.2f %14.1f %14.1f %12.1f %12.1f" % (
+                name, load_time, rss_loaded, rss_total, p50 * 1e6, p99 * 1e6))
+
+if __name__ == '__main__':
+    main()
@@ -11,104 +11,83 @@
 
 from ibm_spectrum_discover_application_sdk.ApplicationMessageBase import ApplicationMessageBase, ApplicationReplyMessage
 from ibm_spectrum_discover_application_sdk.ApplicationLib import ApplicationBase
-from ibm_spectrum_discover_application_sdk.DocumentRetrievalBase import DocumentKey, DocumentRetrievalFactory
+from ibm_spectrum_discover_application_sdk.DocumentRetrievalBase import DocumentKey
 
 import os
 import paramiko
 import logging
 import sys
-import json
-import csv
-import requests
-from urllib.parse import urljoin 
-
-#urllib3.disable_warnings()
-requests.packages.urllib3.disable_warnings(requests.packages.urllib3.exceptions.InsecureRequestWarning)
+from patient_store import open_patient_store, BACKENDS
+#discover_client is copied next to this file in the image, and found in
+#../common when run from the repository
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from discover_client import DiscoverClient, quote
+from agent_supervisor import supervise, handle_stop_signals
+from reply_sender import ReplySender, PollTimeout, read_work_message
+from agent_metrics import Metrics
+from tag_rules import TagRules
 
 ENCODING = 'utf-8'
 
-SD_HOST = ""
-SD_USER = ""
-SD_PASSWORD = ""
-SD_TOKEN = ""
-
-def load_db(csvdb) :
-    """Load the CSV database"""
-    def client_dict(client):
-        return {
-            "name":         client[0],
-            "blood_group":  client[1],
-            "email":        client[2],
-            "age":          client[3],
-            "sex":          client[4],
-            "smoker":       client[5]
-        }
-    data={}
-    with open(csvdb, "r") as db:
-        data = {client[0]: client_dict(client[1:]) for client in csv.reader(db)}
-    return data
-
-def get_token():
-    """Get an API Token using the provided credentials"""
-    global SD_HOST
-    global SD_USER
-    global SD_PASSWORD
-    headers = {}
-    basic_auth = requests.auth.HTTPBasicAuth(SD_USER, SD_PASSWORD)
-    identity_auth_url=urljoin(SD_HOST,"/auth/v1/token")
-    logger.debug("Getting a new token for %s:%s on %s" % (SD_USER,SD_PASSWORD,SD_HOST))
-    try:
-        response = requests.get(identity_auth_url, verify=False, headers=headers, auth=basic_auth)
-        # check response from identity auth server
-        if response.status_code == 200:
-            application_token = response.headers['X-Auth-Token']
-            return application_token
-
-        raise Exception("Attempt to obtain token returned (%d)" % response.status_code)
-    except Exception as exc:
-            logger.error('Application failed to obtain token (%s)', str(exc))
-            raise
-    return
-
-def get_fkey_metadata(fkey):
+#Recorded along the processing, served on AGENT_METRICS_PORT
+metrics = Metrics('db_agent')
+
+#Tags containing a rule's substring get the field of the patient record,
+#overridden by the TAG_RULES environment variable
+TAG_RULES = {
+    "blood_group": "blood_group",
+    "email": "email",
+    "smoker": "smoker",
+}
+
+def get_fkey_metadata(discover, fkey):
     """Get a file (identified through its fkey) metadata, querying Discover"""
-    global SD_TOKEN
-    global SD_HOST
-    headers = {
-        'Content-Type': 'application/json',
-        'Authorization': 'Bearer %s' % SD_TOKEN if SD_TOKEN else ""
-    }
     json_query = {
-        "query":"fkey = '%s'" % fkey,
+        "query":"fkey = %s" % quote(fkey),
         "filters":[],
         "group_by":[],
         "sort_by":[],
         "limit":3
     }
-    query_url=urljoin(SD_HOST,"/db2whrest/v1/search")
-    try:
-        response = requests.post(url=query_url, verify=False, json=json_query, headers=headers, auth=None)
-        #API token may be expired, renew it and retry the query
-        if response.status_code == 401:
-            logger.debug("A new token is required")
-            SD_TOKEN = get_token()
-            logger.debug("New token is %s"%SD_TOKEN)
-            headers = {
-                'Content-Type': 'application/json',
-                'Authorization': 'Bearer %s' % SD_TOKEN
-            }
-            response = requests.post(url=query_url, verify=False, json=json_query, headers=headers, auth=None)
-
-        if response.status_code == 200:
-            result = response.json()
-            metadata = json.loads(result["rows"])
-            if metadata:
-                return metadata[0]
-            return None
-        raise Exception("Metadata failed with code %d" % response.status_code)
-    except Exception as exc:
-        logger.error('Application failed to obtain token (%s)', str(exc))
-        raise
+    metadata = discover.search(json_query)
+    if metadata:
+        return metadata[0]
+    return None
+
+def get_fkeys_metadata(discover, fkeys, chunk_size=100):
+    """Get the metadata of many files (identified through their fkeys), querying Discover
+
+    fkeys are looked up with one "fkey IN (...)" query per chunk of chunk_size
+    keys, and with one query per key for the keys the chunked queries missed.
+    Returns a dict mapping each fkey to its metadata, or None if not found.
+    """
+    metadata = {}
+    unique_fkeys = list(dict.fromkeys(fkeys))
+    for start in range(0, len(unique_fkeys), chunk_size):
+        chunk = unique_fkeys[start:start + chunk_size]
+        json_query = {
+            "query":"fkey IN (%s)" % ", ".join(quote(fkey) for fkey in chunk),
+            "filters":[],
+            "group_by":[],
+            "sort_by":[],
+            #A file can have several records, up to 3 per key as for a single key
+            "limit":3 * len(chunk)
+        }
+        try:
+            rows = discover.search(json_query)
+        except Exception as exc:
+            logger.error('Application failed to query metadata (%s)', str(exc))
+            # Keys of a failed chunk are retried one by one below
+            continue
+        for row in rows:
+            metadata.setdefault(row.get("fkey"), row)
+
+    misses = [fkey for fkey in unique_fkeys if fkey not in metadata]
+    if misses:
+        logger.debug("%d fkeys not found by batched queries, querying them one by one", len(misses))
+    for fkey in misses:
+        metadata[fkey] = get_fkey_metadata(discover, fkey)
+    return metadata
 
 if __name__ == '__main__':
     print("---------------------------------------------------------------------")
@@ -122,23 +101,6 @@ if __name__ == '__main__':
                         level=loglevels[log_level])
     logger = logging.getLogger(__name__)
 
-    registration_info = {
-        "action_id": "DEEPINSPECT",
-        "action_params": ["extract_tags"]
-    }
-
-    # Create application instance
-    application = ApplicationBase(registration_info)
-    # start function performs all required initializations and connections
-    application.start()
-    
-    # Get a message handler (abstraction of Kafka)
-    am = ApplicationMessageBase(application)
-    # Need to create a document retrieval handler for each unique datasource we
-    # receive in the work message, create them dynamically and store them.
-    # May be persisted to re-use over multiple work messages.
-    drh = {}
-
     SD_HOST = os.getenv("SPECTRUM_DISCOVER_HOST","https://localhost")
     SD_PASSWORD = os.getenv("APPLICATION_USER_PASSWORD")
     SD_USER = os.getenv("APPLICATION_USER")
@@ -151,28 +113,112 @@ if __name__ == '__main__':
         valid_username_password = False
     if not valid_username_password:
         raise SystemExit("Missing APPLICATION_USER and or APPLICATION_USER_PASSWORD environment variable.")
+    agent_processes = os.getenv("AGENT_PROCESSES", "1")
+    agent_stop_timeout = os.getenv("AGENT_STOP_TIMEOUT", "120")
+    if not agent_processes.isnumeric() or not agent_stop_timeout.isnumeric():
+        raise SystemExit("AGENT_PROCESSES and AGENT_STOP_TIMEOUT must be numbers.")
+    agent_poll_timeout_min = os.getenv("AGENT_POLL_TIMEOUT_MIN", "1")
+    agent_poll_timeout_max = os.getenv("AGENT_POLL_TIMEOUT_MAX", "30")
+    agent_reply_chunk_size = os.getenv("AGENT_REPLY_CHUNK_SIZE", "1000")
+    agent_pending_replies = os.getenv("AGENT_PENDING_REPLIES", "4")
+    agent_metrics_port = os.getenv("AGENT_METRICS_PORT", "9464")
+    if not all(value.isnumeric() and int(value) > 0 for value in
+               (agent_poll_timeout_min, agent_poll_timeout_max, agent_pending_replies)) \
+            or not agent_reply_chunk_size.isnumeric() or not agent_metrics_port.isnumeric():
+        raise SystemExit("AGENT_POLL_TIMEOUT_MIN, AGENT_POLL_TIMEOUT_MAX, AGENT_PENDING_REPLIES, "
+                         "AGENT_REPLY_CHUNK_SIZE and AGENT_METRICS_PORT must be positive numbers.")
+    query_chunk_size = os.getenv("DISCOVER_QUERY_CHUNK_SIZE", "100")
+    if not query_chunk_size.isnumeric() or int(query_chunk_size) < 1:
+        raise SystemExit("DISCOVER_QUERY_CHUNK_SIZE must be a positive number.")
+    patient_store_backend = os.getenv("PATIENT_STORE", "sqlite")
+    patient_db_reload_interval = os.getenv("PATIENT_DB_RELOAD_INTERVAL", "60")
+    if patient_store_backend not in BACKENDS:
+        raise SystemExit("PATIENT_STORE must be one of %s." % ", ".join(BACKENDS))
+    if not patient_db_reload_interval.isnumeric():
+        raise SystemExit("PATIENT_DB_RELOAD_INTERVAL must be a number.")
+    #Checked here rather than in every process, where an invalid value would
+    #only get them restarted over and over
+    try:
+        tag_rules = TagRules.from_env(TAG_RULES, fields=set(TAG_RULES.values()))
+        discover_settings = DiscoverClient.settings_from_env()
+    except ValueError as ex:
+        raise SystemExit(str(ex))
+
+    #With AGENT_PROCESSES > 1, the rest runs in that many forked processes,
+    #each with its own connections and Kafka consumer in the application's
+    #consumer group, supervised by this process
+    slot = supervise(int(agent_processes), stop_timeout=int(agent_stop_timeout))
+    #SIGTERM (docker stop) ends the loop after the current message is replied to
+    stop = handle_stop_signals()
+    #Each process serves its metrics on its own port, from AGENT_METRICS_PORT
+    #on (0 disables them)
+    if int(agent_metrics_port):
+        metrics.serve(int(agent_metrics_port) + slot)
 
     logger.debug("Host : %s" % SD_HOST)
     logger.debug("User : %s" % SD_USER)
-    logger.debug("Password : %s" % SD_PASSWORD)
 
-    #Load the CSV database.
-    #In our example, to keep it simple, the database is embedded in the container
-    db = load_db("/application/client_database.csv")
+    #One client for the whole run: its connections and API token are reused
+    #across messages
+    discover = DiscoverClient(SD_HOST, SD_USER, SD_PASSWORD, **discover_settings)
+
+    #Open the patient database.
+    #In our example, to keep it simple, the database is embedded in the container.
+    #The default sqlite store looks patients up in an index built from the CSV
+    #(at image build time) instead of loading every patient in memory.
+    #The store is reloaded in the background when the CSV changes, so new
+    #patients are picked up without restarting the agent.
+    db = open_patient_store(os.getenv("PATIENT_DB_PATH", "/application/client_database.csv"),
+                            patient_store_backend, reload_interval=int(patient_db_reload_interval))
+    logger.info("Patient store %s opened: %d patients", patient_store_backend, len(db))
+
+    registration_info = {
+        "action_id": "DEEPINSPECT",
+        "action_params": ["extract_tags"]
+    }
+
+    # Create application instance
+    application = ApplicationBase(registration_info)
+    # start function performs all required initializations and connections
+    application.start()
+    
+    # Get a message handler (abstraction of Kafka)
+    am = ApplicationMessageBase(application)
+    # Documents are not retrieved: their metadata comes from Discover and the
+    # patient database, so no document retrieval handler is needed.
+
+    #Replies are delivered in the background while the next messages are
+    #processed, in parts of AGENT_REPLY_CHUNK_SIZE results for large messages
+    sender = ReplySender(am, max_pending=int(agent_pending_replies), chunk_size=int(agent_reply_chunk_size),
+                         metrics=metrics)
+    #Polls return as soon as a message is available, the timeout only grows
+    #while idle
+    poll_timeout = PollTimeout(int(agent_poll_timeout_min), int(agent_poll_timeout_max))
+    timeout = poll_timeout.minimum
 
     # message processing loop
     logger.info("Looking for job")
-    while True:
-        logger.info("Trying to read messages")
-        msg = am.read_message(timeout=100)  # or timeout can be zero to poll
+    while not stop.is_set():
+        logger.debug("Trying to read messages")
+        msg, message = read_work_message(am, timeout)
+        timeout = poll_timeout.next(message is not None)
 
         if msg:
             # Application can choose to parse message, or as below use provided parse function
             work = am.parse_work_message(msg)
+            metrics.inc('messages_total')
 
             # similar with reply message, can construct manually, or use helpers as below
             reply = ApplicationReplyMessage(msg)
 
+            #Tags are mapped to the patient fields once per distinct extract_tags list
+            tag_mapping = tag_rules.compile(tuple(work['action_params']['extract_tags']))
+
+            #Get the metadata of all the files of the message from Discover at once
+            with metrics.stage('metadata_lookup'):
+                fkeys_metadata = get_fkeys_metadata(discover, [docs["fkey"] for docs in work['docs']],
+                                                    int(query_chunk_size))
+
             for docs in work['docs']:
                 # DocumentKey is a unique identifier for a document, amalgam of connection + name
                 key = DocumentKey(docs)
@@ -190,37 +236,26 @@ if __name__ == '__main__':
                 smoker = ""
                 status='failed'
 
-                #Get file metadata from Discover
-                metadata = get_fkey_metadata(docs["fkey"])
+                metadata = fkeys_metadata[docs["fkey"]]
                 if metadata:
                     #Get the additional metadata from the database. 
                     #metadata["dicom_pid"] contains the Social Security number of the patient
-                    db_line = db[metadata["dicom_pid"]]
+                    with metrics.stage('patient_lookup'):
+                        db_line = db.get(metadata["dicom_pid"])
                     if db_line:
                         blood_group=db_line["blood_group"]
                         email=db_line["email"]
                         smoker=db_line["smoker"]
                         
-                        logger.debug('... blood group : %s' % blood_group)
-                        logger.debug('... email : %s' % email)
-                        logger.debug('... smoker : %s' % smoker)
+                        logger.debug('... blood group : %s', blood_group)
+                        logger.debug('... email : %s', email)
+                        logger.debug('... smoker : %s', smoker)
                         
-                        tags_to_extract = work['action_params']['extract_tags']
-
-                        #Assign value to the corresponding tag
+                        #Assign value to the corresponding tag, as mapped by the tag rules
                         #for example, the blood_group value will be assign to any tag containing the string "blood_group"#
                         #for example, the name of the tag could be dicom_blood_group
-                        for tag in tags_to_extract:
-                            if "blood_group" in tag:
-                                value=blood_group
-                            elif "email" in tag:
-                                value=email
-                            elif "smoker" in tag:
-                                value=smoker
-                            else:
-                                value=""
-                            logger.info("Set %s to %s"%(tag,value))
-                            tags[tag]=value
+                        tags = TagRules.apply(tag_mapping, {"blood_group": blood_group, "email": email,
+                                                            "smoker": smoker})
                         status='success'
                     
                 ##################################################
@@ -228,11 +263,24 @@ if __name__ == '__main__':
                 ##################################################
                 logger.debug(tags)
                 reply.add_result(status, key, tags)
+                metrics.inc('results_total', status=status)
+                reply = sender.send_partial(reply, msg)
             
             # Finally, send our constructed reply
             logger.info("Sending result to Discover")
-            am.send_reply(reply)
+            sender.send(reply, message)
+        elif message:
+            #Invalid or ignored message, only committed
+            sender.send(None, message)
         else:
             # timeout
-            logger.info("Poll timeout reached - passing")
+            logger.debug("Poll timeout reached - passing")
             pass
+
+    logger.info("PID:%d Stopping, sending the pending replies", os.getpid())
+    sender.close(timeout=int(agent_stop_timeout))
+    # Leaves the consumer group right away, its partitions go to the other consumers
+    am.kafka_consumer.close()
+    metrics.close()
+    db.close()
+    discover.close()
@@ -1,9 +1,12 @@
 #!/bin/bash
 SCRIPT_DIR="$( cd "$( dirname "$0" )" && pwd )"
 
-docker stop dbagent
+docker stop -t 130 dbagent
 docker rm dbagent
 docker rmi ibmcom/db-metadata-agent
 cd $SCRIPT_DIR
+# Modules shared with the other applications are copied into the build context
+cp ../common/discover_client.py ../common/agent_supervisor.py ../common/reply_sender.py ../common/agent_metrics.py ../common/tag_rules.py .
 docker build -t ibmcom/db-metadata-agent .
+rm -f discover_client.py agent_supervisor.py reply_sender.py agent_metrics.py tag_rules.py
 
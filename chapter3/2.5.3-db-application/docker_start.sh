@@ -1,6 +1,13 @@
 #!/bin/bash
 SCRIPT_DIR="$( cd "$( dirname "$0" )" && pwd )"
 cd $SCRIPT_DIR
-docker run -d --name dbagent  --mount 'type=bind,src=/gpfs/gpfs0/connections/scale/id_rsa,dst=/keys/id_rsa' --env-file "$SCRIPT_DIR/vars.txt" ibmcom/db-metadata-agent
+# With PATIENT_DB_HOST_DIR set, the patient database is read from that host
+# directory (mounted on /data, set PATIENT_DB_PATH=/data/client_database.csv
+# in vars.txt) and updates to it are picked up without restarting the agent.
+PATIENT_DB_MOUNT=""
+if [ -n "$PATIENT_DB_HOST_DIR" ]; then
+  PATIENT_DB_MOUNT="--mount type=bind,src=$PATIENT_DB_HOST_DIR,dst=/data"
+fi
+docker run -d --name dbagent --stop-timeout 130  --mount 'type=bind,src=/gpfs/gpfs0/connections/scale/id_rsa,dst=/keys/id_rsa' $PATIENT_DB_MOUNT --env-file "$SCRIPT_DIR/vars.txt" ibmcom/db-metadata-agent
 sleep 5
-docker logs dbagent -f
\ No newline at end of file
+docker logs dbagent -f
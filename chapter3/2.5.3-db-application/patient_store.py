@@ -0,0 +1,322 @@
+#!/usr/bin/python -W ignore
+########################################################## {COPYRIGHT-TOP} ###
+# Licensed Materials - Property of IBM
+# 5737-I32
+#
+# (C) Copyright IBM Corp. 2019
+#
+# US Government Users Restricted Rights - Use, duplication, or
+# disclosure restricted by GSA ADP Schedule Contract with IBM Corp.
+########################################################## {COPYRIGHT-END} ###
+"""Patient stores: lookup of the patient database by social security number.
+
+The patient database is a CSV file with one patient per line:
+ssn,name,blood_group,email,age,sex,smoker
+
+Backends:
+    dict ....... every patient parsed into a dict at startup (small samples)
+    compact .... columnar arrays searched by bisection, a fraction of the memory of dict
+    sqlite ..... SQLite index on SSN built once next to the CSV (again when the CSV
+                 changes), nothing parsed at startup
+
+ReloadingPatientStore wraps any backend and swaps in a new store in the
+background when the CSV changes.
+
+To build the SQLite index ahead of time (e.g. when building the image):
+    python3 patient_store.py /application/client_database.csv
+"""
+
+import os
+import sys
+import csv
+import time
+import array
+import bisect
+import sqlite3
+import tempfile
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+FIELDS = ("name", "blood_group", "email", "age", "sex", "smoker")
+
+def read_patients(csvdb):
+    """Yield the rows of the CSV database, skipping the header line"""
+    with open(csvdb, "r", newline="") as db:
+        for client in csv.reader(db):
+            if client and client[0] != "ssn":
+                yield client
+
+def file_signature(path):
+    """Return the (mtime in ns, size) of a file, None if it does not exist"""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+def load_db(csvdb) :
+    """Load the CSV database"""
+    def client_dict(client):
+        return {
+            "name":         client[0],
+            "blood_group":  client[1],
+            "email":        client[2],
+            "age":          client[3],
+            "sex":          client[4],
+            "smoker":       client[5]
+        }
+    data={}
+    with open(csvdb, "r") as db:
+        data = {client[0]: client_dict(client[1:]) for client in csv.reader(db)}
+    return data
+
+class PatientStore():
+    """Lookup of patient records by social security number."""
+
+    def get(self, ssn):
+        """Return the patient record (a dict of FIELDS) of ssn, or None."""
+        raise NotImplementedError
+
+    def __len__(self):
+        raise NotImplementedError
+
+    def close(self):
+        """Release the resources held by the store."""
+
+class DictPatientStore(PatientStore):
+    """All patients parsed into a dict of dicts, as load_db() does."""
+
+    def __init__(self, csvdb):
+        self.data = load_db(csvdb)
+        self.data.pop("ssn", None)
+
+    def get(self, ssn):
+        return self.data.get(ssn)
+
+    def __len__(self):
+        return len(self.data)
+
+class CompactPatientStore(PatientStore):
+    """All patients held in columns, looked up by bisection on the sorted SSNs.
+
+    SSNs are stored as integers in an array, names and emails packed in one
+    UTF-8 buffer each, low cardinality fields (blood group, sex, smoker) as one
+    byte codes and age as a short. A patient costs a few dozen bytes instead of
+    a dict and its strings.
+    """
+
+    def __init__(self, csvdb):
+        ssns = array.array("q")
+        self.ages = array.array("h")
+        self.names = bytearray()
+        self.name_offsets = array.array("Q", [0])
+        self.emails = bytearray()
+        self.email_offsets = array.array("Q", [0])
+        # code -> value tables and codes of the low cardinality columns
+        self.categories = {"blood_group": {}, "sex": {}, "smoker": {}}
+        self.codes = {field: array.array("B") for field in self.categories}
+
+        for client in read_patients(csvdb):
+            key = self.ssn_key(client[0])
+            if key is None:
+                logger.warning("Skipping patient with invalid SSN: %s", client[0])
+                continue
+            ssns.append(key)
+            self.names += client[1].encode("utf-8")
+            self.name_offsets.append(len(self.names))
+            self.emails += client[3].encode("utf-8")
+            self.email_offsets.append(len(self.emails))
+            self.ages.append(int(client[4]))
+            for field, value in (("blood_group", client[2]), ("sex", client[5]), ("smoker", client[6])):
+                values = self.categories[field]
+                self.codes[field].append(values.setdefault(value, len(values)))
+
+        self.categories = {field: list(values) for field, values in self.categories.items()}
+        # Columns stay in file order, rows[i] is the row of the i-th smallest SSN
+        self.rows = array.array("L", sorted(range(len(ssns)), key=ssns.__getitem__))
+        self.ssns = array.array("q", (ssns[row] for row in self.rows))
+
+    @staticmethod
+    def ssn_key(ssn):
+        """Return the integer key of a ddd-dd-dddd SSN, or None"""
+        digits = ssn.replace("-", "")
+        return int(digits) if digits.isdigit() and len(digits) == 9 else None
+
+    def get(self, ssn):
+        key = self.ssn_key(ssn)
+        if key is None:
+            return None
+        i = bisect.bisect_left(self.ssns, key)
+        if i == len(self.ssns) or self.ssns[i] != key:
+            return None
+        row = self.rows[i]
+        return {
+            "name":         self.names[self.name_offsets[row]:self.name_offsets[row + 1]].decode("utf-8"),
+            "blood_group":  self.categories["blood_group"][self.codes["blood_group"][row]],
+            "email":        self.emails[self.email_offsets[row]:self.email_offsets[row + 1]].decode("utf-8"),
+            "age":          str(self.ages[row]),
+            "sex":          self.categories["sex"][self.codes["sex"][row]],
+            "smoker":       self.categories["smoker"][self.codes["smoker"][row]]
+        }
+
+    def __len__(self):
+        return len(self.ssns)
+
+class SQLitePatientStore(PatientStore):
+    """Patients in a SQLite database indexed on SSN.
+
+    The database records the mtime and size of the CSV it was built from. It
+    is built again when missing or when the CSV differs (even one replaced
+    by an older file), and otherwise opened as is: startup does not depend
+    on the number of patients and they are not held in memory.
+    """
+
+    def __init__(self, csvdb, index_path=None):
+        self.index_path = index_path or os.path.splitext(csvdb)[0] + ".db"
+        self.lock = threading.Lock()
+        self.conn = None
+        if os.path.exists(self.index_path):
+            self.conn = sqlite3.connect("file:%s?mode=ro" % self.index_path, uri=True, check_same_thread=False)
+            if self.source() != file_signature(csvdb):
+                self.conn.close()
+                self.conn = None
+        if self.conn is None:
+            self.build(csvdb, self.index_path)
+            self.conn = sqlite3.connect("file:%s?mode=ro" % self.index_path, uri=True, check_same_thread=False)
+
+    def source(self):
+        """Return the (mtime in ns, size) of the CSV the index was built from, None if unknown"""
+        try:
+            return self.conn.execute("SELECT mtime_ns, size FROM source").fetchone()
+        except sqlite3.DatabaseError:
+            # An index built before the source was recorded
+            return None
+
+    @staticmethod
+    def build(csvdb, index_path):
+        """Build the SQLite database of a CSV database"""
+        logger.info("Building patient index %s from %s", index_path, csvdb)
+        # Taken before reading: a CSV changed meanwhile is indexed again
+        signature = file_signature(csvdb)
+        # Each builder (agent processes may build at once) writes its own file
+        fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(index_path) + ".",
+                                        dir=os.path.dirname(os.path.abspath(index_path)))
+        os.close(fd)
+        try:
+            conn = sqlite3.connect(tmp_path)
+            try:
+                conn.execute("PRAGMA journal_mode=OFF")
+                conn.execute("PRAGMA synchronous=OFF")
+                conn.execute("CREATE TABLE patients (ssn TEXT PRIMARY KEY, %s) WITHOUT ROWID" % ", ".join(FIELDS))
+                conn.executemany("INSERT OR REPLACE INTO patients VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                 (client[:7] for client in read_patients(csvdb)))
+                conn.execute("CREATE TABLE source (mtime_ns INTEGER, size INTEGER)")
+                conn.execute("INSERT INTO source VALUES (?, ?)", signature)
+                conn.commit()
+            finally:
+                conn.close()
+            # Readers only ever see a complete index
+            os.replace(tmp_path, index_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def get(self, ssn):
+        with self.lock:
+            row = self.conn.execute("SELECT %s FROM patients WHERE ssn = ?" % ", ".join(FIELDS), (ssn,)).fetchone()
+        return dict(zip(FIELDS, row)) if row else None
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM patients").fetchone()[0]
+
+    def close(self):
+        self.conn.close()
+
+class ReloadingPatientStore(PatientStore):
+    """A patient store reloaded in the background when its CSV changes.
+
+    A thread checks the CSV every interval seconds. Once a change has settled
+    (same size and mtime on two checks, so a file being copied is not loaded
+    half way) a new store is opened and swapped in with a single assignment:
+    lookups never wait for a reload and always see a complete store. A store
+    that fails to load is logged and the current one kept, and the reload is
+    retried at the next checks.
+    """
+
+    def __init__(self, csvdb, backend="sqlite", interval=60):
+        self.csvdb = csvdb
+        self.backend = backend
+        self.interval = interval
+        self.loaded_signature = self.signature()
+        self.store = open_patient_store(csvdb, backend)
+        # The swapped out store may still serve an in-flight lookup, it is
+        # closed at the next swap only
+        self.retired = None
+        self.thread = threading.Thread(name="patient_store_reload", target=self.watch, daemon=True)
+        self.thread.start()
+
+    def signature(self):
+        return file_signature(self.csvdb)
+
+    def watch(self):
+        pending = None
+        while True:
+            time.sleep(self.interval)
+            signature = self.signature()
+            if signature is None or signature == self.loaded_signature:
+                pending = None
+            elif signature != pending:
+                # Changed since the last check, wait for it to settle
+                pending = signature
+            else:
+                self.reload(signature)
+                pending = None
+
+    def reload(self, signature):
+        """Open a new store of the CSV and swap it in"""
+        start = time.time()
+        try:
+            store = open_patient_store(self.csvdb, self.backend)
+            rows = len(store)
+        except Exception as exc:
+            logger.error("Could not reload patient database %s (%s), keeping the current one", self.csvdb, str(exc))
+            return
+        if self.retired:
+            self.retired.close()
+        self.retired, self.store = self.store, store
+        self.loaded_signature = signature
+        logger.info("Patient database %s reloaded in %.2fs: %d patients", self.csvdb, time.time() - start, rows)
+
+    def get(self, ssn):
+        return self.store.get(ssn)
+
+    def __len__(self):
+        return len(self.store)
+
+BACKENDS = {
+    "dict": DictPatientStore,
+    "compact": CompactPatientStore,
+    "sqlite": SQLitePatientStore,
+}
+
+def open_patient_store(csvdb, backend="sqlite", reload_interval=0):
+    """Open the patient store of a CSV database with the given backend
+
+    With a reload_interval (in seconds), the store is reloaded in the
+    background when the CSV changes.
+    """
+    if backend not in BACKENDS:
+        raise ValueError("Unknown patient store backend %s, expected one of %s" % (backend, ", ".join(BACKENDS)))
+    if reload_interval:
+        return ReloadingPatientStore(csvdb, backend, reload_interval)
+    return BACKENDS[backend](csvdb)
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+    if len(sys.argv) != 2:
+        raise SystemExit("Usage: %s <client_database.csv>" % sys.argv[0])
+    store = SQLitePatientStore(sys.argv[1])
+    logger.info("%d patients indexed in %s", len(store), store.index_path)
@@ -3,4 +3,7 @@ SCRIPT_DIR="$( cd "$( dirname "$0" )" && pwd )"
 cd $SCRIPT_DIR
 docker rm spectrum-discover-inference-api
 docker rmi ibmcom/spectrum-discover-inference-api
+# Modules shared with the other applications are copied into the build context
+cp ../common/agent_supervisor.py ../common/reply_sender.py ../common/agent_metrics.py ../common/tag_rules.py .
 docker build -t ibmcom/spectrum-discover-inference-api .
+rm -f agent_supervisor.py reply_sender.py agent_metrics.py tag_rules.py
@@ -0,0 +1,171 @@
+#!/usr/bin/python -W ignore
+########################################################## {COPYRIGHT-TOP} ###
+# Licensed Materials - Property of IBM
+# 5737-I32
+#
+# (C) Copyright IBM Corp. 2019
+#
+# US Government Users Restricted Rights - Use, duplication, or
+# disclosure restricted by GSA ADP Schedule Contract with IBM Corp.
+########################################################## {COPYRIGHT-END} ###
+"""Local staging of the documents to infer, retrieved ahead of inference."""
+
+import os
+import time
+import hashlib
+import logging
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+class StagedDocument():
+    """A private copy of a retrieved document."""
+
+    def __init__(self, path, digest, size):
+        self.path = path
+        self.digest = digest
+        self.size = size
+
+class StagingArea():
+    """Documents retrieved in the background into a local staging directory.
+
+    Documents are retrieved one at a time in submission order by a background
+    thread, so the next documents are being copied while the current ones are
+    inferred. (Retrieval handlers are not thread-safe, and retrieving in order
+    guarantees the documents of the oldest batch are never stuck behind later
+    ones waiting for budget.)
+    At most prefetch documents are staged or being staged at once (submit()
+    blocks beyond that), and the staged files stay within budget bytes, but
+    for the documents of the oldest unfinished batch which are always
+    admitted so that it can complete.
+
+    Every staged file is removed by release(), and every batch must be closed
+    with finish_batch(). Retrievals are timed into metrics, when given.
+    """
+
+    def __init__(self, budget, prefetch, directory=None, metrics=None):
+        self.budget = budget
+        self.directory = directory
+        self.metrics = metrics
+        self.slots = threading.Semaphore(prefetch)
+        self.condition = threading.Condition()
+        self.open_batches = set()
+        self.staged_bytes = 0
+        self.staged_documents = 0
+        self.queued = 0
+        self.retrievals = 0
+        self.retrieval_time = 0.0
+        self.max_retrieval_time = 0.0
+        self.budget_wait_time = 0.0
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='staging')
+
+    def submit(self, batch_id, key, handler, lock):
+        """Schedule the retrieval of a document of a batch
+
+        Returns a future of its StagedDocument, or None when the document
+        could not be retrieved. Retrieval errors are raised by the future.
+        """
+        self.slots.acquire()
+        with self.condition:
+            self.open_batches.add(batch_id)
+            self.queued += 1
+        return self.executor.submit(self.stage, batch_id, key, handler, lock)
+
+    def stage(self, batch_id, key, handler, lock):
+        """Retrieve a document and copy it to a private staged file.
+
+        Retrieval handlers keep per-document state (Scale and COS handlers even
+        download to a fixed per-process path), so the handler lock is held
+        until the document is copied, the private copies being inferred
+        concurrently.
+        The content is hashed during the copy for the result cache.
+        """
+        with self.condition:
+            self.queued -= 1
+        staged = None
+        start = time.time()
+        if self.metrics:
+            self.metrics.add('in_flight', 1, stage='retrieve')
+        try:
+            with lock:
+                tmpfile_path = handler.get_document(key)
+                logger.debug("File retrieved : %s ", tmpfile_path)
+                try:
+                    if not tmpfile_path:
+                        return None
+                    staged = self.copy(batch_id, key, tmpfile_path)
+                finally:
+                    handler.cleanup_document()
+        finally:
+            if not staged:
+                self.slots.release()
+            elapsed = time.time() - start
+            with self.condition:
+                self.retrievals += 1
+                self.retrieval_time += elapsed
+                self.max_retrieval_time = max(self.max_retrieval_time, elapsed)
+            if self.metrics:
+                self.metrics.observe('stage_seconds', elapsed, stage='retrieve')
+                self.metrics.add('in_flight', -1, stage='retrieve')
+        return staged
+
+    def copy(self, batch_id, key, tmpfile_path):
+        """Copy a retrieved file into the staging directory, within the budget"""
+        size = os.path.getsize(tmpfile_path)
+        start = time.time()
+        with self.condition:
+            self.condition.wait_for(lambda: self.staged_bytes + size <= self.budget or not self.staged_bytes
+                                    or batch_id == min(self.open_batches))
+            self.staged_bytes += size
+            self.staged_documents += 1
+            self.budget_wait_time += time.time() - start
+        try:
+            suffix = '.' + key.filetype if key.filetype else ''
+            fd, staged_path = tempfile.mkstemp(prefix='inference_', suffix=suffix, dir=self.directory)
+            sha256 = hashlib.sha256()
+            try:
+                with os.fdopen(fd, 'wb') as dst, open(tmpfile_path, 'rb') as src:
+                    for chunk in iter(lambda: src.read(1024 * 1024), b''):
+                        sha256.update(chunk)
+                        dst.write(chunk)
+            except OSError:
+                os.remove(staged_path)
+                raise
+        except Exception:
+            self.unreserve(size)
+            raise
+        return StagedDocument(staged_path, sha256.hexdigest(), size)
+
+    def unreserve(self, size):
+        with self.condition:
+            self.staged_bytes -= size
+            self.staged_documents -= 1
+            self.condition.notify_all()
+
+    def release(self, staged):
+        """Remove a staged file and free its budget and prefetch slot"""
+        try:
+            os.remove(staged.path)
+        except FileNotFoundError:
+            pass
+        self.unreserve(staged.size)
+        self.slots.release()
+
+    def finish_batch(self, batch_id):
+        """Mark a batch done: its documents no longer bypass the budget"""
+        with self.condition:
+            self.open_batches.discard(batch_id)
+            self.condition.notify_all()
+
+    def stats(self):
+        """Return the staging counters."""
+        with self.condition:
+            return {'staged_bytes': self.staged_bytes,
+                    'staged_documents': self.staged_documents,
+                    'queued': self.queued,
+                    'retrievals': self.retrievals,
+                    'mean_retrieval_time': self.retrieval_time / self.retrievals if self.retrievals else 0.0,
+                    'max_retrieval_time': self.max_retrieval_time,
+                    'budget_wait_time': self.budget_wait_time}
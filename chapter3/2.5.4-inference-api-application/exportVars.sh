@@ -7,4 +7,27 @@ export LOG_LEVEL=DEBUG
 export INFERENCE_API_SERVER_HOST=http://10.7.13.200
 export INFERENCE_API_SERVER_ENDPOINT=/infer
 export INFERENCE_API_SERVER_PORT=5757 
+export INFERENCE_API_SERVER_BATCH_ENDPOINT=/infer_batch
+export INFERENCE_API_SERVER_HEALTH_ENDPOINT=/health
+export INFERENCE_API_BATCH_SIZE=8
+export INFERENCE_API_CONCURRENCY=4
+export INFERENCE_API_POOL_SIZE=4
+export INFERENCE_API_CONNECT_TIMEOUT=5
+export INFERENCE_API_READ_TIMEOUT=300
+export INFERENCE_API_RETRIES=3
+export INFERENCE_API_BACKOFF=0.5
+export INFERENCE_CACHE_PATH=/home/moadmin/inference-api-application/inference_results.db
+export INFERENCE_CACHE_MAX_ENTRIES=100000
+export INFERENCE_CACHE_VERSION_INTERVAL=60
+export INFERENCE_PREFETCH=8
+export INFERENCE_STAGING_BUDGET_MB=1024
+export INFERENCE_MAX_HANDLERS=16
+export INFERENCE_HANDLER_IDLE_TIMEOUT=600
+export AGENT_PROCESSES=1
+export AGENT_STOP_TIMEOUT=120
+export AGENT_POLL_TIMEOUT_MIN=1
+export AGENT_POLL_TIMEOUT_MAX=30
+export AGENT_REPLY_CHUNK_SIZE=1000
+export AGENT_PENDING_REPLIES=4
+export AGENT_METRICS_PORT=9464
 
@@ -0,0 +1,138 @@
+#!/usr/bin/python -W ignore
+########################################################## {COPYRIGHT-TOP} ###
+# Licensed Materials - Property of IBM
+# 5737-I32
+#
+# (C) Copyright IBM Corp. 2019
+#
+# US Government Users Restricted Rights - Use, duplication, or
+# disclosure restricted by GSA ADP Schedule Contract with IBM Corp.
+########################################################## {COPYRIGHT-END} ###
+"""Cache of the document retrieval handlers of the data source connections."""
+
+import time
+import logging
+import threading
+from collections import OrderedDict
+from ibm_spectrum_discover_application_sdk.DocumentRetrievalBase import DocumentRetrievalFactory
+
+logger = logging.getLogger(__name__)
+
+class HandlerEntry():
+    """A retrieval handler, its lock and its users."""
+
+    def __init__(self, handler):
+        self.handler = handler
+        # Handlers keep per-document state, retrievals through one are serialized
+        self.lock = threading.Lock()
+        self.users = 0
+        self.last_used = time.time()
+        self.stale = False
+
+class HandlerCache():
+    """Document retrieval handlers by connection, bounded in number and idle time.
+
+    A handler is created on the first document of a connection and kept for
+    the next ones. Beyond max_handlers, the least recently used handlers are
+    closed, as are handlers idle for idle_timeout seconds. A handler in use
+    (acquired and not yet released) is never closed: it is evicted after it
+    is released, and the handler of an updated connection is closed when its
+    last user releases it.
+    """
+
+    def __init__(self, application, max_handlers=16, idle_timeout=600):
+        self.application = application
+        self.max_handlers = max_handlers
+        self.idle_timeout = idle_timeout
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.created = 0
+        self.evicted = 0
+        self.updated = 0
+
+    def acquire(self, key):
+        """Return the HandlerEntry of the connection of a document, creating it if needed
+
+        Every acquire() must be paired with a release() of the entry.
+        """
+        with self.lock:
+            entry = self.entries.get(key.id)
+            if entry is None:
+                entry = HandlerEntry(DocumentRetrievalFactory().create(self.application, key))
+                self.entries[key.id] = entry
+                self.created += 1
+                logger.debug("Retrieval handler created for %s", str(key.id))
+            self.entries.move_to_end(key.id)
+            entry.users += 1
+            entry.last_used = time.time()
+            self.evict_lru()
+            return entry
+
+    def release(self, key, entry):
+        """Release the entry acquired for a document"""
+        with self.lock:
+            entry.users -= 1
+            entry.last_used = time.time()
+            if entry.stale and not entry.users:
+                self.close(key.id, entry)
+            else:
+                self.evict_lru()
+
+    def evict_lru(self):
+        # Least recently used first, skipping the handlers in use
+        for conn in list(self.entries):
+            if len(self.entries) <= self.max_handlers:
+                break
+            if not self.entries[conn].users:
+                self.evicted += 1
+                self.close(conn, self.entries.pop(conn))
+
+    def expire_idle(self):
+        """Close the handlers not used for idle_timeout seconds"""
+        now = time.time()
+        with self.lock:
+            for conn in list(self.entries):
+                entry = self.entries[conn]
+                if not entry.users and now - entry.last_used > self.idle_timeout:
+                    self.evicted += 1
+                    self.close(conn, self.entries.pop(conn))
+
+    def process_updates(self):
+        """Close the handlers of the connections updated in Discover, and the idle ones"""
+        while True:
+            try:
+                # This will raise a KeyError when nothing is in the set
+                conn = self.application.kafka_connections_to_update.pop()
+            except KeyError:
+                break
+            with self.lock:
+                entry = self.entries.pop(conn, None)
+                if entry is None:
+                    continue
+                self.updated += 1
+                # The next document of the connection gets a new handler
+                if entry.users:
+                    entry.stale = True
+                else:
+                    self.close(conn, entry)
+        self.expire_idle()
+
+    def close_all(self):
+        """Close every handler, at shutdown"""
+        with self.lock:
+            while self.entries:
+                self.close(*self.entries.popitem())
+
+    def close(self, conn, entry):
+        logger.debug("Closing connection: %s", str(conn))
+        with entry.lock:
+            try:
+                entry.handler.close_connection()
+            except Exception as exc:
+                logger.info("Error while closing connection %s: %s", str(conn), str(exc))
+
+    def stats(self):
+        """Return the handler counters and the number of cached handlers."""
+        with self.lock:
+            return {'handlers': len(self.entries), 'created': self.created,
+                    'evicted': self.evicted, 'updated': self.updated}
@@ -11,30 +11,187 @@
 
 from ibm_spectrum_discover_application_sdk.ApplicationMessageBase import ApplicationMessageBase, ApplicationReplyMessage
 from ibm_spectrum_discover_application_sdk.ApplicationLib import ApplicationBase
-from ibm_spectrum_discover_application_sdk.DocumentRetrievalBase import DocumentKey, DocumentRetrievalFactory
+from ibm_spectrum_discover_application_sdk.DocumentRetrievalBase import DocumentKey
+from inference_client import InferenceClient
+from result_cache import ResultCache
+from document_staging import StagingArea
+from handler_cache import HandlerCache
 
 import os
+import time
 import requests
 import logging
 import sys
 import json
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+#agent_supervisor is copied next to this file in the image, and found in
+#../common when run from the repository
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from agent_supervisor import supervise, handle_stop_signals
+from reply_sender import ReplySender, PollTimeout, read_work_message
+from agent_metrics import Metrics
+from tag_rules import TagRules
 
 ENCODING = 'utf-8'
 
-def check_for_connection_updates(application, drh):
-    """Check for connection updates and close connection if needed."""
-    while True:
-        try:
-            # This will raise a KeyError when nothing is in the set
-            conn = application.kafka_connections_to_update.pop()
+# Recorded along the processing, served on AGENT_METRICS_PORT
+metrics = Metrics('inference_agent')
 
-            logger.debug("Closing connection: %s", str(conn))
-            drh[conn].close_connection()
+# Tags containing a rule's substring get the field of the inference result,
+# overridden by the TAG_RULES environment variable
+TAG_RULES = {
+    "segfile": "filename_seg",
+    "model_version": "model_version",
+    "nodules_count": "nodules_count",
+    "result": "result",
+}
 
-            # Always remove the element without error
-            drh.pop(conn, None)
-        except KeyError:
-            break
+def retrieve_document(key, staging_future):
+    """Wait for a document to be staged for inference.
+
+    Returns a (status, staged) tuple. status is None when the document was
+    staged, staged being a StagedDocument, else it is the result to report
+    for this document.
+    """
+    logger.info('PID:{} Inspecting Document:{}'.format(os.getpid(), key.path))
+
+    # Application does its work on the file based on the action params
+    # get_document the abstracted function that brings back the file path,
+    # called ahead of time by the staging area
+    try:
+        staged = staging_future.result()
+    except AttributeError:
+        logger.info("Connection does not exist for %s. Skipping.", str(key.id))
+        return 'skipped', None
+    except FileNotFoundError:
+        logger.info("Could not find file: %s.", key.path)
+        return 'failed', None
+    except PermissionError:
+        logger.info("Could not open file: %s.", key.path)
+        return 'failed', None
+    except OSError as ex:
+        # e.g. staging directory full (ENOSPC) or I/O error, the agent goes on
+        logger.error("Could not stage file %s: %s", key.path, str(ex))
+        return 'failed', None
+
+    if not staged:
+        return 'failed', None
+    return None, staged
+
+def run_inference(paths, inference_client, use_batch_endpoint):
+    """Send staged files to inference.
+
+    Returns a list of (path, inference result) tuples, the inference result
+    being None for files that could not be inferred.
+    """
+    # Send files to inference through the exposed API and get the result
+    logger.debug("Send %d file(s) to inference", len(paths))
+    try:
+        if use_batch_endpoint:
+            response = inference_client.infer_batch(paths)
+        else:
+            response = inference_client.infer(paths[0])
+    except requests.exceptions.RequestException as ex:
+        logger.info("Error while sending %s to inference: %s.", ", ".join(paths), ex)
+        return [(path, None) for path in paths]
+
+    #Parse the JSON output
+    try:
+        logger.debug("JSON : %.200s", response.text)
+        logger.debug("HTTP Code : %s", str(response.status_code))
+        output = response.json()
+        if not use_batch_endpoint:
+            return [(paths[0], output)]
+        # The batch endpoint answers a result list keyed by the uploaded file names
+        results = {entry["filename"]: entry for entry in output["results"]}
+    except (json.decoder.JSONDecodeError, KeyError, TypeError) as ex:
+        logger.info("Error while reading the inference response: %s.", ex)
+        return [(path, None) for path in paths]
+    return [(path, results.get(os.path.basename(path))) for path in paths]
+
+def extract_tags(inference_result, tag_mapping):
+    """Build the tags of a document from its inference result.
+
+    tag_mapping is the extract_tags of the work message compiled by
+    TagRules.compile().
+    """
+    ##################################################
+    ################ Start Custom Code ###############
+    ##################################################
+    #Retrieve the value from the inference result
+    model_version=str(inference_result["model_version"])
+    filename_seg=inference_result["filename_seg"]
+    nodules_count=str(inference_result["obj_count"])
+    result=json.dumps(inference_result["result"])
+
+    logger.debug('... modele version : %s', model_version)
+    logger.debug('... filename seg : %s', filename_seg)
+    logger.debug('... nodule count : %s', nodules_count)
+    logger.debug('... result : %s', result)
+
+    #Assign value to the corresponding tag, as mapped by the tag rules
+    #for example, the nodules_count value will be assign to any tag containing the string "nodules_count"#
+    #for example, the name of the tag could be inference_nodule_count
+    tags = TagRules.apply(tag_mapping, {"filename_seg": filename_seg, "model_version": model_version,
+                                        "nodules_count": nodules_count, "result": result})
+    ##################################################
+    ################# End Custom Code ################
+    ##################################################
+    return tags
+
+def process_batch(batch_id, batch, tag_mapping, inference_client, use_batch_endpoint, staging,
+                  result_cache=None):
+    """Wait for a batch of documents to be staged, send them to inference and build their tags.
+
+    batch is a list of (key, staging future) tuples. Documents whose content
+    was already inferred are answered from result_cache without any request.
+    Staged files are released whatever happens.
+    Returns the list of (status, tags) tuples to add to the reply message,
+    in the batch order.
+    """
+    results = [None] * len(batch)
+    # staged file path -> (position in the batch, staged document)
+    staged = {}
+    to_infer = []
+    try:
+        for i, (key, staging_future) in enumerate(batch):
+            status, staged_doc = retrieve_document(key, staging_future)
+            if not staged_doc:
+                results[i] = (status, None)
+                continue
+            staged[staged_doc.path] = (i, staged_doc)
+            cached = result_cache.get(staged_doc.digest) if result_cache else None
+            if cached:
+                logger.debug("Cached inference result for %s", key.path)
+                results[i] = ('success', extract_tags(cached, tag_mapping))
+            else:
+                to_infer.append(staged_doc.path)
+
+        if to_infer:
+            with metrics.stage('infer'):
+                inferred = run_inference(to_infer, inference_client, use_batch_endpoint)
+            for tmpfile_path, inference_result in inferred:
+                i, staged_doc = staged[tmpfile_path]
+                try:
+                    results[i] = ('success', extract_tags(inference_result, tag_mapping))
+                except (KeyError, TypeError) as ex:
+                    logger.info("No inference result for %s: %s.", batch[i][0].path, str(ex))
+                    results[i] = ('failed', None)
+                    continue
+                if result_cache:
+                    result_cache.put(staged_doc.digest, inference_result)
+    finally:
+        # Documents not waited for above (on errors) are released once staged
+        for key, staging_future in batch:
+            try:
+                staged_doc = staging_future.result()
+            except Exception:
+                staged_doc = None
+            if staged_doc:
+                staging.release(staged_doc)
+        staging.finish_batch(batch_id)
+    return results
 
 if __name__ == '__main__':
     # Instantiate logger
@@ -51,6 +208,24 @@ if __name__ == '__main__':
     inference_server_host = os.environ.get('INFERENCE_API_SERVER_HOST', '')
     inference_server_endpoint = os.environ.get('INFERENCE_API_SERVER_ENDPOINT', '/infer')
     inference_server_port = os.environ.get('INFERENCE_API_SERVER_PORT', '5757')
+    inference_batch_endpoint = os.environ.get('INFERENCE_API_SERVER_BATCH_ENDPOINT', '/infer_batch')
+    inference_health_endpoint = os.environ.get('INFERENCE_API_SERVER_HEALTH_ENDPOINT', '/health')
+    inference_batch_size = os.environ.get('INFERENCE_API_BATCH_SIZE', '1')
+    inference_concurrency = os.environ.get('INFERENCE_API_CONCURRENCY', '4')
+    inference_cache_path = os.environ.get('INFERENCE_CACHE_PATH', '')
+    inference_cache_max_entries = os.environ.get('INFERENCE_CACHE_MAX_ENTRIES', '100000')
+    inference_cache_version_interval = os.environ.get('INFERENCE_CACHE_VERSION_INTERVAL', '60')
+    inference_prefetch = os.environ.get('INFERENCE_PREFETCH', '8')
+    inference_staging_budget_mb = os.environ.get('INFERENCE_STAGING_BUDGET_MB', '1024')
+    inference_max_handlers = os.environ.get('INFERENCE_MAX_HANDLERS', '16')
+    inference_handler_idle_timeout = os.environ.get('INFERENCE_HANDLER_IDLE_TIMEOUT', '600')
+    agent_processes = os.environ.get('AGENT_PROCESSES', '1')
+    agent_stop_timeout = os.environ.get('AGENT_STOP_TIMEOUT', '120')
+    agent_poll_timeout_min = os.environ.get('AGENT_POLL_TIMEOUT_MIN', '1')
+    agent_poll_timeout_max = os.environ.get('AGENT_POLL_TIMEOUT_MAX', '30')
+    agent_reply_chunk_size = os.environ.get('AGENT_REPLY_CHUNK_SIZE', '1000')
+    agent_pending_replies = os.environ.get('AGENT_PENDING_REPLIES', '4')
+    agent_metrics_port = os.environ.get('AGENT_METRICS_PORT', '9464')
     
     valid_inference_vars=True
     if not inference_server_host:
@@ -62,11 +237,102 @@ if __name__ == '__main__':
     if not inference_server_port.isnumeric():
         logger.error("INFERENCE_API_SERVER_PORT is not a number.")
         valid_inference_vars=False
+    if not inference_batch_size.isnumeric() or int(inference_batch_size) < 1:
+        logger.error("INFERENCE_API_BATCH_SIZE is not a positive number.")
+        valid_inference_vars=False
+    if not inference_concurrency.isnumeric() or int(inference_concurrency) < 1:
+        logger.error("INFERENCE_API_CONCURRENCY is not a positive number.")
+        valid_inference_vars=False
+    if not inference_cache_max_entries.isnumeric():
+        logger.error("INFERENCE_CACHE_MAX_ENTRIES is not a number.")
+        valid_inference_vars=False
+    if not inference_cache_version_interval.isnumeric() or int(inference_cache_version_interval) < 1:
+        logger.error("INFERENCE_CACHE_VERSION_INTERVAL is not a positive number.")
+        valid_inference_vars=False
+    if not inference_prefetch.isnumeric() or int(inference_prefetch) < 1:
+        logger.error("INFERENCE_PREFETCH is not a positive number.")
+        valid_inference_vars=False
+    if not inference_staging_budget_mb.isnumeric():
+        logger.error("INFERENCE_STAGING_BUDGET_MB is not a number.")
+        valid_inference_vars=False
+    if not inference_max_handlers.isnumeric() or int(inference_max_handlers) < 1:
+        logger.error("INFERENCE_MAX_HANDLERS is not a positive number.")
+        valid_inference_vars=False
+    if not inference_handler_idle_timeout.isnumeric():
+        logger.error("INFERENCE_HANDLER_IDLE_TIMEOUT is not a number.")
+        valid_inference_vars=False
+    if not agent_processes.isnumeric() or int(agent_processes) < 1:
+        logger.error("AGENT_PROCESSES is not a positive number.")
+        valid_inference_vars=False
+    if not agent_stop_timeout.isnumeric():
+        logger.error("AGENT_STOP_TIMEOUT is not a number.")
+        valid_inference_vars=False
+    if not agent_poll_timeout_min.isnumeric() or int(agent_poll_timeout_min) < 1:
+        logger.error("AGENT_POLL_TIMEOUT_MIN is not a positive number.")
+        valid_inference_vars=False
+    if not agent_poll_timeout_max.isnumeric() or int(agent_poll_timeout_max) < 1:
+        logger.error("AGENT_POLL_TIMEOUT_MAX is not a positive number.")
+        valid_inference_vars=False
+    if not agent_reply_chunk_size.isnumeric():
+        logger.error("AGENT_REPLY_CHUNK_SIZE is not a number.")
+        valid_inference_vars=False
+    if not agent_pending_replies.isnumeric() or int(agent_pending_replies) < 1:
+        logger.error("AGENT_PENDING_REPLIES is not a positive number.")
+        valid_inference_vars=False
+    if not agent_metrics_port.isnumeric():
+        logger.error("AGENT_METRICS_PORT is not a number.")
+        valid_inference_vars=False
+    try:
+        tag_rules = TagRules.from_env(TAG_RULES, fields=set(TAG_RULES.values()))
+    except ValueError as ex:
+        logger.error(str(ex))
+        valid_inference_vars=False
+    # The connection pool defaults to a connection per concurrent batch
+    try:
+        inference_client_settings = InferenceClient.settings_from_env(
+            int(inference_concurrency) if inference_concurrency.isnumeric() else 4)
+    except ValueError as ex:
+        logger.error(str(ex))
+        valid_inference_vars=False
     if not valid_inference_vars:
         raise SystemExit("Missing one or more environment variables.")
 
+    # With AGENT_PROCESSES > 1, the rest runs in that many forked processes,
+    # each with its own connections, cache connection, staging area and Kafka
+    # consumer in the application's consumer group, supervised by this process
+    slot = supervise(int(agent_processes), stop_timeout=int(agent_stop_timeout))
+    # SIGTERM (docker stop) ends the loop after the current message is replied to
+    stop = handle_stop_signals()
+    # Each process serves its metrics on its own port, from AGENT_METRICS_PORT
+    # on (0 disables them)
+    if int(agent_metrics_port):
+        metrics.serve(int(agent_metrics_port) + slot)
+
     inference_server_url=inference_server_host + ':' + inference_server_port + inference_server_endpoint
+    inference_batch_url=inference_server_host + ':' + inference_server_port + inference_batch_endpoint
+    inference_health_url=inference_server_host + ':' + inference_server_port + inference_health_endpoint
     logger.debug("Inference server : %s" % inference_server_url)
+    # Keep-alive connections to the inference server, shared by all workers
+    inference_client = InferenceClient(inference_server_url, batch_url=inference_batch_url,
+                                       health_url=inference_health_url, **inference_client_settings)
+    # Documents are sent one per request to the single file endpoint, or grouped
+    # in multipart requests to the batch endpoint
+    batch_size = int(inference_batch_size)
+    use_batch_endpoint = batch_size > 1
+    # Results of already inferred contents, an empty INFERENCE_CACHE_PATH disables it.
+    # Lookups are for the model version the inference server reports on its
+    # health endpoint, checked every INFERENCE_CACHE_VERSION_INTERVAL seconds.
+    result_cache = None
+    next_version_check = 0
+    if inference_cache_path:
+        result_cache = ResultCache(inference_cache_path, max_entries=int(inference_cache_max_entries),
+                                   model_version=os.environ.get('INFERENCE_CACHE_MODEL_VERSION'))
+    # Documents are retrieved ahead of inference into a local staging area.
+    # A partial batch holds its staged documents until it is complete, so at
+    # least a batch of documents must fit in the prefetch.
+    prefetch = max(int(inference_prefetch), batch_size)
+    staging = StagingArea(budget=int(inference_staging_budget_mb) * 1024 * 1024, prefetch=prefetch,
+                          directory=os.environ.get('INFERENCE_STAGING_DIR') or None, metrics=metrics)
         
     registration_info = {
         "action_id": "DEEPINSPECT",
@@ -83,126 +349,115 @@ if __name__ == '__main__':
 
     # Need to create a document retrieval handler for each unique datasource we
     # receive in the work message, create them dynamically and store them.
-    # May be persisted to re-use over multiple work messages.
-    drh = {}
+    # They are re-used over work messages, up to INFERENCE_MAX_HANDLERS handlers
+    # and for INFERENCE_HANDLER_IDLE_TIMEOUT seconds without documents.
+    drh = HandlerCache(application, max_handlers=int(inference_max_handlers),
+                       idle_timeout=int(inference_handler_idle_timeout))
+    batch_ids = itertools.count()
+
+    # Batches of documents of a work message are processed by a bounded pool of
+    # workers so that retrieval, upload and inference of several batches overlap
+    executor = ThreadPoolExecutor(max_workers=int(inference_concurrency))
+    logger.info("Processing up to %s batches of %d document(s) concurrently", inference_concurrency, batch_size)
+
+    # Replies are delivered in the background while the next messages are
+    # processed, in parts of AGENT_REPLY_CHUNK_SIZE results for large messages
+    # (0 replies to a message at once). A work message is committed once all
+    # its results are delivered.
+    sender = ReplySender(am, max_pending=int(agent_pending_replies), chunk_size=int(agent_reply_chunk_size),
+                         metrics=metrics)
+    # Polls return as soon as a message is available; when idle, their timeout
+    # grows from AGENT_POLL_TIMEOUT_MIN up to AGENT_POLL_TIMEOUT_MAX seconds
+    poll_timeout = PollTimeout(int(agent_poll_timeout_min), int(agent_poll_timeout_max))
+    timeout = poll_timeout.minimum
 
     # message processing loop
     logger.info("Looking for job")
-    while True:
-        logger.info("Trying to read messages")
-        msg = am.read_message(timeout=100)  # or timeout can be zero to poll
+    while not stop.is_set():
+        logger.debug("Trying to read messages")
+        msg, message = read_work_message(am, timeout)
+        timeout = poll_timeout.next(message is not None)
+
+        if result_cache and time.time() >= next_version_check:
+            result_cache.set_model_version(inference_client.model_version())
+            next_version_check = time.time() + int(inference_cache_version_interval)
 
         if msg:
             # Application can choose to parse message, or as below use provided parse function
             work = am.parse_work_message(msg)
+            metrics.inc('messages_total')
 
             # similar with reply message, can construct manually, or use helpers as below
             reply = ApplicationReplyMessage(msg)
 
-            for docs in work['docs']:
-
-                # check to see if there are any connection updates available and close them
-                check_for_connection_updates(application, drh)
+            # check to see if there are any connection updates available and close them.
+            # Done once per message, handlers in use are closed once released.
+            drh.process_updates()
 
+            # Tags are mapped to the result fields once per distinct extract_tags list
+            tag_mapping = tag_rules.compile(tuple(work['action_params']['extract_tags']))
+            batch_id = next(batch_ids)
+            batch = []
+            futures = []
+            for docs in work['docs']:
                 # DocumentKey is a unique identifier for a document, amalgam of connection + name
                 key = DocumentKey(docs)
-                # Create and store a retriever for this if we haven't yet
-                if key.id not in drh:
-                    drh[key.id] = DocumentRetrievalFactory().create(application, key)
+                # Get the retriever of the connection, created if we haven't yet,
+                # and held until the document is staged
+                entry = drh.acquire(key)
+                # Retrieval starts right away, blocking while the prefetch is full
+                staging_future = staging.submit(batch_id, key, entry.handler, entry.lock)
+                staging_future.add_done_callback(lambda _, key=key, entry=entry: drh.release(key, entry))
+                batch.append((key, staging_future))
+                if len(batch) == batch_size:
+                    futures.append((batch, executor.submit(process_batch, batch_id, batch, tag_mapping,
+                                                           inference_client, use_batch_endpoint, staging,
+                                                           result_cache)))
+                    batch_id = next(batch_ids)
+                    batch = []
+            if batch:
+                futures.append((batch, executor.submit(process_batch, batch_id, batch, tag_mapping,
+                                                       inference_client, use_batch_endpoint, staging,
+                                                       result_cache)))
+            else:
+                staging.finish_batch(batch_id)
 
-                logger.info('PID:{} Inspecting Document:{}'.format(os.getpid(), key.path))
+            # Results are gathered in document order, and sent as soon as a
+            # part of the reply is complete
+            for batch, future in futures:
+                for (key, _), (status, tags) in zip(batch, future.result()):
+                    reply.add_result(status, key, tags)
+                    metrics.inc('results_total', status=status)
+                reply = sender.send_partial(reply, msg)
 
-                # Application does its work on the file based on the action params
-                # get_document the abstracted function that brings back the file path
-                try:
-                    tmpfile_path = drh[key.id].get_document(key)
-                except AttributeError:
-                    logger.info("Connection does not exist for %s. Skipping.", str(key.id))
-                    reply.add_result('skipped', key)
-                    continue
-                logger.debug("File retrieved : %s ", tmpfile_path)
-
-                if tmpfile_path:
-                    ##################################################
-                    ################ Start Custom Code ###############
-                    ##################################################
-                    model_version=""
-                    filename_seg=""
-                    nodules_count=""
-                    result=""
-                    tags = {}
-                    logger.debug("Open the file : %s ", tmpfile_path)
-                    try:
-                        files = {'file': open(tmpfile_path,'rb')}
-                    except FileNotFoundError:
-                        logger.info("Could not find file: %s.", tmpfile_path)
-                        reply.add_result('failed', key)
-                        continue
-                    except PermissionError:
-                        logger.info("Could not open file: %s.", tmpfile_path)
-                        reply.add_result('failed', key)
-                        continue
-
-                    # Send file to inference through the exposed API and get the result
-                    logger.debug("Send file to  : %s ", inference_server_url)
-                    try:
-                        response = requests.post(inference_server_url, files=files)
-                    except requests.exceptions.RequestException as ex:
-                        logger.info("Error while sending file %s to inference: %s.", tmpfile_path, ex)
-                        reply.add_result('failed', key)
-                        continue
-                    
-                    #Parse the JSON output and retrieve the value
-                    try:
-                        logger.debug("JSON : %s", response.text)
-                        logger.debug("HTTP Code : %s", str(response.status_code))
-                        dict=response.json()
-                        model_version=str(dict["model_version"])
-                        filename_seg=dict["filename_seg"]
-                        nodules_count=str(dict["obj_count"])
-                        result=json.dumps(dict["result"])
-                    except json.decoder.JSONDecodeError as ex:
-                        logger.info("Error while reading the inference response: %s.", ex)
-                        reply.add_result('failed', key)
-                        continue
-
-                    logger.debug('... modele version : %s' % model_version)
-                    logger.debug('... filename seg : %s' % filename_seg)
-                    logger.debug('... nodule count : %s' % nodules_count)
-                    logger.debug('... result : %s' % result)
-
-                    #Assign value to the corresponding tag
-                    #for example, the nodules_count value will be assign to any tag containing the string "nodules_count"#
-                    #for example, the name of the tag could be inference_nodule_count
-                    tags_to_extract = work['action_params']['extract_tags']
-                    for tag in tags_to_extract:
-                        if "segfile" in tag:
-                            value=filename_seg
-                        elif "model_version" in tag:
-                            value=model_version
-                        elif "nodules_count" in tag:
-                            value=nodules_count
-                        elif "result" in tag:
-                            value=result
-                        else:
-                            value=""
-                        logger.debug("Set %s to %s"%(tag,value))
-                        tags[tag]=value
-                    status='success'
-                    ##################################################
-                    ################# End Custom Code ################
-                    ##################################################
-
-                    drh[key.id].cleanup_document()
-                    reply.add_result('success', key, tags)
-                else:
-                    reply.add_result('failed', key)
+            logger.info("Staging: %(staged_documents)d documents, %(staged_bytes)d bytes staged, "
+                        "%(queued)d queued, retrieval %(mean_retrieval_time).3fs mean "
+                        "%(max_retrieval_time).3fs max, %(budget_wait_time).1fs waited for budget",
+                        staging.stats())
+            logger.info("Retrieval handlers: %(handlers)d open, %(created)d created, %(evicted)d evicted, "
+                        "%(updated)d updated", drh.stats())
+            if result_cache:
+                logger.info("Result cache: %(hits)d hits, %(misses)d misses, %(entries)d entries",
+                            result_cache.stats())
+
+            logger.info("Replies: %(sent)d sent (%(partial)d partial), %(failed)d failed, "
+                        "%(pending)d pending, %(delivery_time).1fs delivering", sender.stats())
 
             logger.info("Sending result to Discover")
-            am.send_reply(reply)
+            sender.send(reply, message)
+        elif message:
+            # Invalid or ignored message, only committed
+            sender.send(None, message)
         else:
             # timeout
-            logger.info("Poll timeout reached - passing")
-            pass
-
+            logger.debug("Poll timeout reached - passing")
+            drh.expire_idle()
 
+    logger.info("PID:%d Stopping, sending the pending replies", os.getpid())
+    sender.close(timeout=int(agent_stop_timeout))
+    # Leaves the consumer group right away, its partitions go to the other consumers
+    am.kafka_consumer.close()
+    metrics.close()
+    executor.shutdown()
+    drh.close_all()
+    inference_client.close()
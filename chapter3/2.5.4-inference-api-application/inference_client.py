@@ -0,0 +1,139 @@
+#!/usr/bin/python -W ignore
+########################################################## {COPYRIGHT-TOP} ###
+# Licensed Materials - Property of IBM
+# 5737-I32
+#
+# (C) Copyright IBM Corp. 2019
+#
+# US Government Users Restricted Rights - Use, duplication, or
+# disclosure restricted by GSA ADP Schedule Contract with IBM Corp.
+########################################################## {COPYRIGHT-END} ###
+"""HTTP client for the inference API."""
+
+import os
+import logging
+from contextlib import ExitStack
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+def env_number(name, default, cast=float, minimum=None):
+    """Return the number in environment variable name, else default
+
+    Raises ValueError when it is not a number, or is below minimum (by
+    default, when it is not positive).
+    """
+    value = os.environ.get(name, default)
+    try:
+        number = cast(value)
+    except ValueError:
+        raise ValueError("%s is not a number: %s" % (name, value))
+    if number < minimum if minimum is not None else number <= 0:
+        raise ValueError("%s must be %s: %s" % (name, "positive" if minimum is None else ">= %s" % minimum, value))
+    return number
+
+class InferenceClient():
+    """A client sending documents to the inference API.
+
+    All requests go through one requests.Session so TCP connections are kept
+    alive and reused from a bounded pool instead of being opened per document.
+    Connection errors and 5xx answers are retried with an exponential backoff.
+
+    This client expects configuration parameters to be specified as environment
+    variables (see from_env).
+
+    INFERENCE_API_POOL_SIZE .......... Max number of kept-alive connections
+                                       - default: 4
+    INFERENCE_API_CONNECT_TIMEOUT .... Connect timeout in seconds
+                                       - default: 5
+    INFERENCE_API_READ_TIMEOUT ....... Read timeout in seconds
+                                       - default: 300
+    INFERENCE_API_RETRIES ............ Number of retries on errors
+                                       - default: 3
+    INFERENCE_API_BACKOFF ............ Backoff factor between retries in seconds
+                                       - default: 0.5
+    """
+
+    RETRY_STATUS_CODES = (500, 502, 503, 504)
+
+    def __init__(self, url, batch_url=None, pool_size=4, connect_timeout=5, read_timeout=300,
+                 retries=3, backoff_factor=0.5, health_url=None):
+        """Create the session and its connection pool."""
+        self.url = url
+        self.batch_url = batch_url
+        self.health_url = health_url
+        self.timeout = (connect_timeout, read_timeout)
+
+        retry = Retry(total=retries,
+                      backoff_factor=backoff_factor,
+                      status_forcelist=self.RETRY_STATUS_CODES,
+                      # inference is idempotent, POST can be retried
+                      allowed_methods=None,
+                      raise_on_status=False)
+        # pool_block makes workers wait for a free connection rather than
+        # opening extra connections that would be dropped afterwards
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                              pool_block=True, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        logger.debug("Inference client for %s: pool size %d, timeouts %s, %d retries",
+                     url, pool_size, str(self.timeout), retries)
+
+    @classmethod
+    def from_env(cls, url, batch_url=None, pool_size=4, health_url=None):
+        """Create a client configured through environment variables."""
+        return cls(url, batch_url=batch_url, health_url=health_url, **cls.settings_from_env(pool_size))
+
+    @staticmethod
+    def settings_from_env(pool_size=4):
+        """Return the keyword arguments of the client set by environment variables
+
+        Raises ValueError naming the first invalid variable, so that the
+        agent can check them at startup.
+        """
+        return {'pool_size': env_number('INFERENCE_API_POOL_SIZE', pool_size, int, minimum=1),
+                'connect_timeout': env_number('INFERENCE_API_CONNECT_TIMEOUT', 5),
+                'read_timeout': env_number('INFERENCE_API_READ_TIMEOUT', 300),
+                'retries': env_number('INFERENCE_API_RETRIES', 3, int, minimum=0),
+                'backoff_factor': env_number('INFERENCE_API_BACKOFF', 0.5, minimum=0)}
+
+    def infer(self, path):
+        """Send the file at path to inference and return the HTTP response.
+
+        The file is closed before returning, whatever the outcome.
+        Raises requests.exceptions.RequestException when all retries failed.
+        """
+        with open(path, 'rb') as f:
+            return self.session.post(self.url, files={'file': (os.path.basename(path), f)},
+                                     timeout=self.timeout)
+
+    def infer_batch(self, paths):
+        """Send the files at paths in one request to the batch endpoint.
+
+        Files are uploaded under their base name, which keys the result list
+        of the response. All files are closed before returning.
+        Raises requests.exceptions.RequestException when all retries failed.
+        """
+        with ExitStack() as stack:
+            files = [('files', (os.path.basename(path), stack.enter_context(open(path, 'rb'))))
+                     for path in paths]
+            return self.session.post(self.batch_url, files=files, timeout=self.timeout)
+
+    def model_version(self):
+        """Return the model version reported by the health endpoint, None when unknown."""
+        if not self.health_url:
+            return None
+        try:
+            # An unhealthy server (503) still reports its model version
+            response = self.session.get(self.health_url, timeout=self.timeout[0])
+            return response.json().get("model_version")
+        except (requests.exceptions.RequestException, ValueError) as ex:
+            logger.warning("Could not get the model version from %s: %s", self.health_url, str(ex))
+            return None
+
+    def close(self):
+        """Close all pooled connections."""
+        self.session.close()
@@ -0,0 +1,115 @@
+#!/usr/bin/python -W ignore
+########################################################## {COPYRIGHT-TOP} ###
+# Licensed Materials - Property of IBM
+# 5737-I32
+#
+# (C) Copyright IBM Corp. 2019
+#
+# US Government Users Restricted Rights - Use, duplication, or
+# disclosure restricted by GSA ADP Schedule Contract with IBM Corp.
+########################################################## {COPYRIGHT-END} ###
+"""Persistent cache of inference results."""
+
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+class ResultCache():
+    """A local cache of inference results keyed by content hash and model version.
+
+    Results are stored in a SQLite database so they survive restarts. The least
+    recently used entries are evicted once the cache holds more than
+    max_entries results.
+
+    Lookups use the version of the model currently served: the pinned
+    model_version, else the one set_model_version() is given from the health
+    endpoint of the inference server, or the last one an inference returned
+    when the server does not report it. Until a version is known, every
+    lookup misses, so results of a previous model are not served.
+    """
+
+    def __init__(self, path, max_entries=100000, model_version=None):
+        """Open or create the cache database."""
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS results ("
+                          "digest TEXT, model_version TEXT, result TEXT, last_used REAL, "
+                          "PRIMARY KEY (digest, model_version))")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)")
+        self.pinned = bool(model_version)
+        self.model_version = model_version or None
+        self.entries = self.conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+        logger.info("Result cache %s: %d entries, model version %s", path, self.entries, model_version)
+
+    def get(self, digest):
+        """Return the cached inference result of a content hash, or None."""
+        with self.lock:
+            row = None
+            if self.model_version:
+                row = self.conn.execute("SELECT result FROM results WHERE digest = ? AND model_version = ?",
+                                        (digest, self.model_version)).fetchone()
+            if not row:
+                self.misses += 1
+                return None
+            self.conn.execute("UPDATE results SET last_used = ? WHERE digest = ? AND model_version = ?",
+                              (time.time(), digest, self.model_version))
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, digest, result):
+        """Store the inference result of a content hash."""
+        model_version = str(result["model_version"])
+        with self.lock:
+            if model_version != self.model_version:
+                if self.pinned:
+                    logger.warning("Inference returned model version %s, not caching results of pinned version %s",
+                                   model_version, self.model_version)
+                    return
+                self._switch(model_version)
+            value, now = json.dumps(result), time.time()
+            inserted = self.conn.execute("INSERT OR IGNORE INTO results VALUES (?, ?, ?, ?)",
+                                         (digest, model_version, value, now)).rowcount
+            if inserted:
+                self.entries += 1
+            else:
+                # Stored meanwhile, e.g. by a concurrent duplicate
+                self.conn.execute("UPDATE results SET result = ?, last_used = ? WHERE digest = ? AND model_version = ?",
+                                  (value, now, digest, model_version))
+            if self.entries > self.max_entries:
+                self.entries = self.conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+            if self.entries > self.max_entries:
+                # evict a tenth more, to not pay for a DELETE on every insert
+                self.conn.execute("DELETE FROM results WHERE rowid IN "
+                                  "(SELECT rowid FROM results ORDER BY last_used LIMIT ?)",
+                                  (self.entries - self.max_entries + self.max_entries // 10,))
+                self.entries = self.conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def set_model_version(self, model_version):
+        """Look up the results of model_version, the version currently served.
+
+        Ignored when the version is pinned or model_version is None (unknown).
+        """
+        if model_version is None or self.pinned:
+            return
+        with self.lock:
+            if str(model_version) != self.model_version:
+                self._switch(str(model_version))
+
+    def _switch(self, model_version):
+        logger.info("Inference model version is now %s", model_version)
+        self.model_version = model_version
+
+    def stats(self):
+        """Return the hit and miss counters and the number of cached results."""
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': self.entries}
@@ -0,0 +1,145 @@
+#!/usr/bin/python -W ignore
+########################################################## {COPYRIGHT-TOP} ###
+# Licensed Materials - Property of IBM
+# 5737-I32
+#
+# (C) Copyright IBM Corp. 2019
+#
+# US Government Users Restricted Rights - Use, duplication, or
+# disclosure restricted by GSA ADP Schedule Contract with IBM Corp.
+########################################################## {COPYRIGHT-END} ###
+"""Metrics of the agents, exposed in the Prometheus text format.
+
+Counters, in-flight gauges and latency histograms are kept in memory and
+served over HTTP on /metrics, for Prometheus to scrape:
+
+    <prefix>_results_total{status="success"}     results sent in the replies
+    <prefix>_stage_seconds{stage="infer"}        latency histogram of a stage
+    <prefix>_in_flight{stage="infer"}            operations of a stage in progress
+
+Recording a value takes a lock and a few additions, so it can be done on
+every document. Only the standard library is used: the images of the
+agents need no other package.
+"""
+
+import time
+import bisect
+import logging
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds, from a cached lookup to a slow inference
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+class Metrics():
+    """Counters, gauges and histograms of an agent, by name and labels."""
+
+    def __init__(self, prefix, buckets=BUCKETS):
+        self.prefix = prefix
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.types = {}
+        # (name, labels) -> value, or [bucket counts, sum, count] for histograms
+        self.values = {}
+        self.server = None
+
+    def inc(self, name, amount=1, **labels):
+        """Add amount to a counter"""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.types.setdefault(name, 'counter')
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def add(self, name, amount, **labels):
+        """Add amount (maybe negative) to a gauge"""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.types.setdefault(name, 'gauge')
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def observe(self, name, seconds, **labels):
+        """Record a duration in a histogram"""
+        key = (name, tuple(sorted(labels.items())))
+        i = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            self.types.setdefault(name, 'histogram')
+            histogram = self.values.get(key)
+            if histogram is None:
+                histogram = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            if i < len(self.buckets):
+                histogram[0][i] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    @contextmanager
+    def stage(self, stage):
+        """Time a stage into stage_seconds, counting it in in_flight meanwhile"""
+        self.add('in_flight', 1, stage=stage)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('stage_seconds', time.perf_counter() - start, stage=stage)
+            self.add('in_flight', -1, stage=stage)
+
+    def render(self):
+        """Return the metrics in the Prometheus text format"""
+        with self.lock:
+            types = dict(self.types)
+            values = [(key, list(value) if isinstance(value, list) else value)
+                      for key, value in self.values.items()]
+        lines = []
+        for name, kind in sorted(types.items()):
+            metric = "%s_%s" % (self.prefix, name)
+            lines.append("# TYPE %s %s" % (metric, kind))
+            for (value_name, labels), value in sorted(values, key=lambda item: item[0]):
+                if value_name != name:
+                    continue
+                if kind != 'histogram':
+                    lines.append("%s%s %s" % (metric, format_labels(labels), value))
+                    continue
+                counts, total, count = value
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append("%s_bucket%s %d" % (metric, format_labels(labels + (('le', str(bound)),)), cumulative))
+                lines.append("%s_bucket%s %d" % (metric, format_labels(labels + (('le', '+Inf'),)), count))
+                lines.append("%s_sum%s %s" % (metric, format_labels(labels), total))
+                lines.append("%s_count%s %d" % (metric, format_labels(labels), count))
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port, host=''):
+        """Serve /metrics on port in a background thread"""
+        metrics = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, format, *args):
+                pass
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name='metrics', daemon=True).start()
+        logger.info("Metrics served on port %d", self.server.server_address[1])
+        return self.server
+
+    def close(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                             for name, value in labels)
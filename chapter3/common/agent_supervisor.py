@@ -0,0 +1,103 @@
+#!/usr/bin/python -W ignore
+########################################################## {COPYRIGHT-TOP} ###
+# Licensed Materials - Property of IBM
+# 5737-I32
+#
+# (C) Copyright IBM Corp. 2019
+#
+# US Government Users Restricted Rights - Use, duplication, or
+# disclosure restricted by GSA ADP Schedule Contract with IBM Corp.
+########################################################## {COPYRIGHT-END} ###
+"""Multi-process mode and graceful shutdown of the agents.
+
+An agent calls supervise() once its configuration is validated, before it
+opens any connection, thread or database: with several processes, the call
+forks them and only returns in the children, which each create their own
+application and Kafka consumer. The consumers share the consumer group of
+the application, so Kafka spreads the partitions of the work topic across
+them. The parent process restarts the children that die, and stops them on
+SIGTERM or SIGINT.
+
+The agent then calls handle_stop_signals() and checks the returned event
+between messages, so that the message in progress is finished and its reply
+sent before the process exits.
+"""
+
+import os
+import sys
+import time
+import signal
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+def handle_stop_signals():
+    """Return an event set on SIGTERM or SIGINT, instead of being killed by them"""
+    stop = threading.Event()
+    def handler(signum, frame):
+        logger.info("PID:%d Signal %d received, stopping after the current message", os.getpid(), signum)
+        stop.set()
+    signal.signal(signal.SIGTERM, handler)
+    signal.signal(signal.SIGINT, handler)
+    return stop
+
+def supervise(processes, stop_timeout=120, restart_delay=1, max_restart_delay=60):
+    """Run the agent in processes child processes.
+
+    Returns 0 right away with a single process. Otherwise, returns in each
+    forked child its slot, from 0 to processes - 1, e.g. to pick a port. A
+    restarted child gets the slot of the one it replaces.
+
+    The parent supervises the children and never returns. A child that
+    exits is restarted after restart_delay seconds, doubled up to
+    max_restart_delay while children keep dying within 10 seconds. On
+    SIGTERM or SIGINT, the children are sent SIGTERM and given stop_timeout
+    seconds to finish their message before being killed.
+    """
+    if processes <= 1:
+        return 0
+    stop = handle_stop_signals()
+    children = {}
+    delay = restart_delay
+    logger.info("PID:%d Supervising %d agent processes", os.getpid(), processes)
+    while not stop.is_set():
+        for slot in sorted(set(range(processes)) - {slot for slot, _ in children.values()}):
+            pid = os.fork()
+            if pid == 0:
+                # In the child: run the agent, with the default signal handling
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                return slot
+            children[pid] = (slot, time.time())
+            logger.info("PID:%d Started agent process %d", os.getpid(), pid)
+
+        pid, status = os.waitpid(-1, os.WNOHANG)
+        if not pid:
+            stop.wait(1)
+            continue
+        lifetime = time.time() - children.pop(pid)[1]
+        logger.error("PID:%d Agent process %d exited (%s) after %ds", os.getpid(), pid, describe(status), lifetime)
+        delay = min(delay * 2, max_restart_delay) if lifetime < 10 else restart_delay
+        stop.wait(delay)
+
+    logger.info("PID:%d Stopping %d agent processes", os.getpid(), len(children))
+    for pid in children:
+        os.kill(pid, signal.SIGTERM)
+    deadline = time.time() + stop_timeout
+    while children and time.time() < deadline:
+        pid, status = os.waitpid(-1, os.WNOHANG)
+        if pid:
+            children.pop(pid, None)
+        else:
+            time.sleep(0.2)
+    for pid in children:
+        logger.error("PID:%d Agent process %d did not stop in %ds, killing it", os.getpid(), pid, stop_timeout)
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+    sys.exit(0)
+
+def describe(status):
+    if os.WIFSIGNALED(status):
+        return "signal %d" % os.WTERMSIG(status)
+    return "code %d" % os.WEXITSTATUS(status)
@@ -0,0 +1,459 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+End-to-end benchmark of the inference and db agents, without Spectrum
+Discover, Kafka or an inference server.
+
+The agent scripts run unchanged, with local stand-ins:
+
+  Kafka ........ the application's consumer feeds synthetic work messages
+                 (docs of a fake connection) and its producer collects the
+                 replies, read by the real ApplicationMessageBase
+  retrieval .... documents are a local file of --doc-size KB, retrieved in
+                 --retrieve-latency seconds
+  Discover ..... discover_stub_server.py, with one record per document
+                 pointing to a patient of a generated patient database
+  inference .... a stub /infer and /infer_batch server answering after
+                 --infer-latency seconds per request
+
+Each agent and message size runs in its own process. Reported: documents
+per second, the latency percentiles of the work messages (poll to last
+reply delivered), the peak memory of the agent process, and the results
+that were not successful. With --baseline, the run fails when the
+throughput dropped by more than --tolerance from a previous --json output:
+
+    python3 benchmark_agents.py --docs-per-message 10,100,1000 --messages 20 --json baseline.json
+    python3 benchmark_agents.py --docs-per-message 10,100,1000 --messages 20 --baseline baseline.json
+
+Agent settings are passed with --env, e.g. --env INFERENCE_API_BATCH_SIZE=8.
+
+--smoke is a quick check that the agents still work, e.g. before a commit:
+one work message of 10 documents per agent, failing unless every result is
+successful.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import runpy
+import signal
+import socket
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import discover_stub_server
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+AGENTS = {
+    "inference": os.path.join(HERE, "..", "2.5.4-inference-api-application", "inference_api.py"),
+    "db": os.path.join(HERE, "..", "2.5.3-db-application", "db_agent.py"),
+}
+EXTRACT_TAGS = {
+    "inference": ["inference_segfile", "inference_model_version", "inference_nodules_count", "inference_result"],
+    "db": ["dicom_blood_group", "dicom_email", "dicom_smoker"],
+}
+USER, PASSWORD = "bench", "bench"
+BLOOD_GROUPS = ["O+", "A+", "B+", "AB+", "O-", "A-", "B-", "AB-"]
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of a list of values"""
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, int(round(p / 100.0 * len(values) + 0.5)) - 1))]
+
+
+def ssn(i):
+    return "%03d-%02d-%04d" % (i // 10**6 % 1000, i // 10**4 % 100, i % 10**4)
+
+
+def fkey(message, doc):
+    return "bench-%d-%d" % (message, doc)
+
+
+# Stand-ins of the servers, run by the driver process
+
+class InferenceStub(BaseHTTPRequestHandler):
+    """/infer and /infer_batch answering like stub_model.py after a latency"""
+    latency = 0.0
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        # Headers and body are written separately: without this, delayed ACKs
+        # stall every keep-alive response by tens of milliseconds
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path not in ("/infer", "/infer_batch"):
+            self.send_error(404)
+            return
+        time.sleep(self.latency)
+        names = [name.decode("utf-8") for name in re.findall(rb'filename="([^"]+)"', body)]
+        results = [{"filename": name, "model_version": "stub-0.0.1",
+                    "filename_seg": os.path.splitext(name)[0] + "_seg.nrrd",
+                    "obj_count": 1, "result": [{"nodule": 0, "score": 0.5}]} for name in names]
+        data = json.dumps(results[0] if self.path == "/infer" and results else {"results": results}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_inference_stub(latency):
+    handler = type("InferenceStubHandler", (InferenceStub,), {"latency": latency})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def start_discover_stub(messages, docs_per_message, patients):
+    """Discover records of every document of the benchmark, each of a patient"""
+    records = [{"fkey": fkey(m, d), "path": "/bench/%s.dcm" % fkey(m, d),
+                "dicom_pid": ssn((m * docs_per_message + d) % patients)}
+               for m in range(messages) for d in range(docs_per_message)]
+    stub = discover_stub_server.DiscoverStub(USER, PASSWORD, records)
+    return stub, discover_stub_server.serve(stub, "127.0.0.1")
+
+
+def write_patients(path, patients):
+    with open(path, "w") as db:
+        db.write("ssn,name,blood_group,mail,age,sex,smoker\n")
+        for i in range(patients):
+            db.write("%s,Patient %d,%s,patient%d@example.com,%d,%s,%s\n"
+                     % (ssn(i), i, BLOOD_GROUPS[i % 8], i, 20 + i % 70, "MF"[i % 2], i % 3 == 0))
+
+
+# Stand-ins of Kafka and of the document retrieval, run in the agent process
+
+class FakeKafkaMessage():
+    def __init__(self, value, offset):
+        self._value = value
+        self._offset = offset
+
+    def value(self):
+        return self._value
+
+    def error(self):
+        return None
+
+    def topic(self):
+        return "work"
+
+    def partition(self):
+        return 0
+
+    def offset(self):
+        return self._offset
+
+
+class ReplyTracker():
+    """Poll and reply times of the work messages"""
+
+    def __init__(self, sizes):
+        self.expected = dict(sizes)
+        self.replied = dict.fromkeys(self.expected, 0)
+        self.polled = {}
+        self.done = {}
+        self.statuses = {}
+        self.committed = -1
+        self.lock = threading.Lock()
+
+    def reply(self, reply):
+        now = time.perf_counter()
+        with self.lock:
+            run_id = reply["run_id"]
+            self.replied[run_id] += len(reply["docs"])
+            for doc in reply["docs"]:
+                self.statuses[doc["status"]] = self.statuses.get(doc["status"], 0) + 1
+            if self.replied[run_id] >= self.expected[run_id]:
+                self.done[run_id] = now
+
+    def finished(self):
+        with self.lock:
+            return len(self.done) == len(self.expected) and self.committed == len(self.expected)
+
+
+class FakeConsumer():
+    """Hands out the work messages, then stops the agent once all are replied to and committed"""
+
+    def __init__(self, messages, tracker):
+        self.messages = messages
+        self.tracker = tracker
+        self.next = 0
+        self.stopping = False
+
+    def subscribe(self, topics):
+        pass
+
+    def poll(self, timeout=None):
+        if self.next < len(self.messages):
+            message = self.messages[self.next]
+            self.next += 1
+            with self.tracker.lock:
+                self.tracker.polled["bench-%d" % message.offset()] = time.perf_counter()
+            return message
+        if self.tracker.finished() and not self.stopping:
+            # As docker stop would: the agent drains and exits its loop
+            self.stopping = True
+            os.kill(os.getpid(), signal.SIGTERM)
+        time.sleep(min(timeout or 0, 0.01))
+        return None
+
+    def commit(self, message=None, offsets=None, asynchronous=True):
+        with self.tracker.lock:
+            if offsets:
+                self.tracker.committed = max(self.tracker.committed, max(tp.offset for tp in offsets))
+            else:
+                # Position commit of ApplicationMessageBase.send_reply()
+                self.tracker.committed = self.next
+
+    def close(self):
+        pass
+
+
+class FakeProducer():
+    def __init__(self, tracker):
+        self.tracker = tracker
+        self.queued = []
+
+    def produce(self, topic, value, callback=None):
+        self.queued.append((value, callback))
+
+    def poll(self, timeout=None):
+        return 0
+
+    def flush(self, timeout=None):
+        queued, self.queued = self.queued, []
+        for value, callback in queued:
+            self.tracker.reply(json.loads(value))
+            if callback:
+                callback(None, None)
+        return 0
+
+
+class FakeApplication():
+    """ApplicationBase without registration, connections nor Kafka"""
+    consumer = None
+    producer = None
+
+    def __init__(self, registration_info):
+        self.registration_info = registration_info
+        self.work_q_name = "work"
+        self.compl_q_name = "completion"
+        self.kafka_ignored_run_ids = set()
+        self.kafka_connections_to_update = set()
+        self.conn_details = []
+
+    def start(self, update_registration=False):
+        self.kafka_consumer = self.consumer
+        self.kafka_producer = self.producer
+
+
+class FakeRetrieval():
+    """Retrieval handler of the fake connection, always answering the same local file"""
+    path = None
+    latency = 0.0
+
+    def __init__(self, application, key):
+        pass
+
+    def get_document(self, key):
+        if self.latency:
+            time.sleep(self.latency)
+        return self.path
+
+    def cleanup_document(self):
+        pass
+
+    def close_connection(self):
+        pass
+
+
+def run_scenario(config):
+    """Run an agent on the work messages of config, in this process, and return its measures"""
+    from ibm_spectrum_discover_application_sdk import ApplicationLib, DocumentRetrievalBase
+
+    agent = config["agent"]
+    sizes = []
+    messages = []
+    for m in range(config["messages"]):
+        run_id = "bench-%d" % m
+        docs = [{"fkey": fkey(m, d), "path": "/bench/%s.dcm" % fkey(m, d), "datasource": "bench",
+                 "cluster": "bench", "type": "dcm"} for d in range(config["docs_per_message"])]
+        work = {"mo_ver": "1.0", "run_id": run_id, "policy_id": "bench",
+                "action_params": {"extract_tags": EXTRACT_TAGS[agent]}, "docs": docs}
+        messages.append(FakeKafkaMessage(json.dumps(work).encode("utf-8"), m))
+        sizes.append((run_id, len(docs)))
+    tracker = ReplyTracker(sizes)
+    FakeApplication.consumer = FakeConsumer(messages, tracker)
+    FakeApplication.producer = FakeProducer(tracker)
+    FakeRetrieval.path = config["document"]
+    FakeRetrieval.latency = config["retrieve_latency"]
+    ApplicationLib.ApplicationBase = FakeApplication
+    DocumentRetrievalBase.DocumentRetrievalFactory.create = staticmethod(FakeRetrieval)
+
+    os.environ.update(config["env"])
+    script = os.path.abspath(AGENTS[agent])
+    sys.path.insert(0, os.path.dirname(script))
+    sys.argv = [script]
+    runpy.run_path(script, run_name="__main__")
+
+    latencies = [tracker.done[run_id] - tracker.polled[run_id] for run_id, _ in sizes if run_id in tracker.done]
+    docs = sum(size for _, size in sizes)
+    elapsed = max(tracker.done.values()) - min(tracker.polled.values())
+    return {
+        "agent": agent,
+        "messages": config["messages"],
+        "docs_per_message": config["docs_per_message"],
+        "docs": docs,
+        "elapsed": elapsed,
+        "docs_per_sec": docs / elapsed if elapsed else 0.0,
+        "latency_p50": percentile(latencies, 50),
+        "latency_p90": percentile(latencies, 90),
+        "latency_p99": percentile(latencies, 99),
+        "latency_max": max(latencies),
+        # Linux reports kilobytes
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+        "not_successful": sum(count for status, count in tracker.statuses.items() if status != "success"),
+    }
+
+
+def agent_env(agent, args, workdir, discover, inference):
+    env = {
+        "LOG_LEVEL": args.log_level,
+        "AGENT_PROCESSES": "1",
+        "AGENT_METRICS_PORT": "0",
+        "AGENT_POLL_TIMEOUT_MIN": "1",
+    }
+    if agent == "inference":
+        env.update({
+            "INFERENCE_API_SERVER_HOST": "http://127.0.0.1",
+            "INFERENCE_API_SERVER_PORT": str(inference.server_address[1]),
+            "INFERENCE_CACHE_PATH": "",
+            "INFERENCE_STAGING_DIR": workdir,
+        })
+    else:
+        env.update({
+            "SPECTRUM_DISCOVER_HOST": "http://127.0.0.1:%d" % discover.server_address[1],
+            "APPLICATION_USER": USER,
+            "APPLICATION_USER_PASSWORD": PASSWORD,
+            "PATIENT_DB_PATH": os.path.join(workdir, "patients.csv"),
+            "PATIENT_DB_RELOAD_INTERVAL": "0",
+        })
+    env.update(dict(setting.split("=", 1) for setting in args.env))
+    return env
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--agent", choices=["inference", "db", "both"], default="both")
+    parser.add_argument("--docs-per-message", default="10,100,1000", help="comma separated message sizes")
+    parser.add_argument("--messages", type=int, default=20, help="work messages per run")
+    parser.add_argument("--doc-size", type=int, default=256, help="size of the documents in KB")
+    parser.add_argument("--retrieve-latency", type=float, default=0.0, help="seconds per document retrieval")
+    parser.add_argument("--infer-latency", type=float, default=0.02, help="seconds per inference request")
+    parser.add_argument("--patients", type=int, default=100000, help="patients of the patient database")
+    parser.add_argument("--env", action="append", default=[], help="KEY=VALUE setting of the agents")
+    parser.add_argument("--log-level", default="ERROR", choices=["ERROR", "WARNING", "INFO", "DEBUG"])
+    parser.add_argument("--timeout", type=float, default=600, help="seconds allowed per run")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--baseline", help="results of a previous --json run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed throughput drop from the baseline")
+    parser.add_argument("--smoke", action="store_true", help="one message of 10 documents per agent, "
+                        "failing on any result that is not successful")
+    parser.add_argument("--run-scenario", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.smoke:
+        args.messages, args.docs_per_message, args.patients = 1, "10", 1000
+        args.timeout = min(args.timeout, 120)
+
+    if args.run_scenario:
+        # In the agent process: the agent logs to stdout, the result goes to a file
+        with open(args.run_scenario) as f:
+            config = json.load(f)
+        result = run_scenario(config)
+        with open(args.run_scenario, "w") as f:
+            json.dump(result, f)
+        return
+
+    agents = ["inference", "db"] if args.agent == "both" else [args.agent]
+    sizes = [int(size) for size in args.docs_per_message.split(",")]
+    with tempfile.TemporaryDirectory(prefix="benchmark_agents_") as workdir:
+        document = os.path.join(workdir, "document.dcm")
+        with open(document, "wb") as f:
+            f.write(os.urandom(args.doc_size * 1024))
+        if "db" in agents:
+            write_patients(os.path.join(workdir, "patients.csv"), args.patients)
+        inference = start_inference_stub(args.infer_latency)
+
+        results = []
+        print("%-9s %5s %7s %9s %9s %9s %9s %9s %8s" % ("agent", "docs", "msgs", "docs/s", "p50 (s)", "p90 (s)",
+                                                       "p99 (s)", "max (s)", "RSS (MB)"))
+        for agent in agents:
+            for size in sizes:
+                stub, discover = (start_discover_stub(args.messages, size, args.patients) if agent == "db"
+                                  else (None, None))
+                config = {"agent": agent, "messages": args.messages, "docs_per_message": size, "document": document,
+                          "retrieve_latency": args.retrieve_latency,
+                          "env": agent_env(agent, args, workdir, discover, inference)}
+                scenario = os.path.join(workdir, "scenario.json")
+                with open(scenario, "w") as f:
+                    json.dump(config, f)
+                try:
+                    run = subprocess.run([sys.executable, os.path.abspath(__file__), "--run-scenario", scenario],
+                                         stdout=None if args.log_level != "ERROR" else subprocess.DEVNULL,
+                                         timeout=args.timeout)
+                finally:
+                    if discover:
+                        discover.shutdown()
+                if run.returncode:
+                    raise SystemExit("The %s agent run of %d documents per message failed" % (agent, size))
+                with open(scenario) as f:
+                    result = json.load(f)
+                results.append(result)
+                print("%-9s %5d %7d %9.1f %9.3f %9.3f %9.3f %9.3f %8.1f%s" % (
+                    agent, size, args.messages, result["docs_per_sec"], result["latency_p50"], result["latency_p90"],
+                    result["latency_p99"], result["latency_max"], result["peak_rss_mb"],
+                    "  (%d not successful)" % result["not_successful"] if result["not_successful"] else ""))
+        inference.shutdown()
+
+    if args.smoke:
+        failed = ["%s agent: %d of %d results not successful" % (result["agent"], result["not_successful"],
+                                                                   result["docs_per_message"] * result["messages"])
+                  for result in results if result["not_successful"]]
+        if failed:
+            raise SystemExit("Smoke test failed:\n  " + "\n  ".join(failed))
+        print("Smoke test passed")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = {(r["agent"], r["docs_per_message"]): r for r in json.load(f)}
+        regressions = []
+        for result in results:
+            before = baseline.get((result["agent"], result["docs_per_message"]))
+            if before and result["docs_per_sec"] < before["docs_per_sec"] * (1 - args.tolerance):
+                regressions.append("%s agent, %d documents per message: %.1f docs/s, %.1f in the baseline" % (
+                    result["agent"], result["docs_per_message"], result["docs_per_sec"], before["docs_per_sec"]))
+        if regressions:
+            raise SystemExit("Throughput regressions:\n  " + "\n  ".join(regressions))
+        print("No throughput regression beyond %d%% of the baseline" % (args.tolerance * 100))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+#!/usr/bin/python -W ignore
+########################################################## {COPYRIGHT-TOP} ###
+# Licensed Materials - Property of IBM
+# 5737-I32
+#
+# (C) Copyright IBM Corp. 2019
+#
+# US Government Users Restricted Rights - Use, duplication, or
+# disclosure restricted by GSA ADP Schedule Contract with IBM Corp.
+########################################################## {COPYRIGHT-END} ###
+"""REST client for the Spectrum Discover search API, shared by the applications."""
+
+import os
+import time
+import json
+import base64
+import itertools
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+requests.packages.urllib3.disable_warnings(requests.packages.urllib3.exceptions.InsecureRequestWarning)
+
+class DiscoverError(Exception):
+    """A Discover API call failed."""
+
+def quote(value):
+    """Quote a string for a search query"""
+    return "'%s'" % value.replace("'", "''")
+
+def token_expiry(token):
+    """Return the expiry time (epoch seconds) of a JWT token, or None
+
+    The payload is decoded without verifying the signature: the expiry is only
+    used to renew the token before Discover rejects it.
+    """
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))['exp'])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return None
+
+def env_number(name, default, cast=float, minimum=None):
+    """Return the number in environment variable name, else default
+
+    Raises ValueError when it is not a number, or is below minimum (by
+    default, when it is not positive).
+    """
+    value = os.environ.get(name, default)
+    try:
+        number = cast(value)
+    except ValueError:
+        raise ValueError("%s is not a number: %s" % (name, value))
+    if number < minimum if minimum is not None else number <= 0:
+        raise ValueError("%s must be %s: %s" % (name, "positive" if minimum is None else ">= %s" % minimum, value))
+    return number
+
+class DiscoverClient():
+    """A thread-safe client of the Discover REST API.
+
+    Requests go through one pooled requests.Session. The API token is cached
+    and renewed refresh_margin seconds before it expires (the expiry is read
+    from the token, or assumed token_lifetime seconds after it was issued), so
+    queries do not pay for a rejected request first. Renewals are single
+    flight: concurrent callers wait for the one renewing the token. A query
+    rejected with 401 anyway is retried once with a new token.
+
+    from_env() reads the configuration from environment variables:
+
+    DISCOVER_POOL_SIZE ........... Max number of kept-alive connections
+                                   - default: 4
+    DISCOVER_TIMEOUT ............. Request timeout in seconds
+                                   - default: 60
+    DISCOVER_TOKEN_LIFETIME ...... Token lifetime in seconds when the token
+                                   does not tell - default: 3600
+    DISCOVER_TOKEN_REFRESH ....... Renew the token that many seconds before
+                                   it expires - default: 60
+    """
+
+    def __init__(self, host, user, password, pool_size=4, timeout=60, token_lifetime=3600,
+                 refresh_margin=60, verify=False):
+        """Create the session and its connection pool."""
+        self.host = host
+        self.user = user
+        self.password = password
+        self.timeout = timeout
+        self.token_lifetime = token_lifetime
+        self.refresh_margin = refresh_margin
+        self.token = None
+        self.token_expires = 0
+        self.token_lock = threading.Lock()
+
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session = requests.Session()
+        self.session.verify = verify
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    @classmethod
+    def from_env(cls, host, user, password):
+        """Create a client configured through environment variables."""
+        return cls(host, user, password, **cls.settings_from_env())
+
+    @staticmethod
+    def settings_from_env():
+        """Return the keyword arguments of the client set by environment variables
+
+        Raises ValueError naming the first invalid variable, so that agents
+        can check them at startup.
+        """
+        return {'pool_size': env_number('DISCOVER_POOL_SIZE', 4, int, minimum=1),
+                'timeout': env_number('DISCOVER_TIMEOUT', 60),
+                'token_lifetime': env_number('DISCOVER_TOKEN_LIFETIME', 3600),
+                'refresh_margin': env_number('DISCOVER_TOKEN_REFRESH', 60, minimum=0)}
+
+    def get_token(self, rejected=None):
+        """Return a valid API token, getting a new one when needed
+
+        rejected is a token Discover refused: it is renewed even if not expired,
+        unless another caller already replaced it.
+        """
+        token = self.token
+        if token and token != rejected and time.time() < self.token_expires - self.refresh_margin:
+            return token
+        with self.token_lock:
+            # Another caller may have renewed the token while we waited
+            if self.token and self.token != rejected and time.time() < self.token_expires - self.refresh_margin:
+                return self.token
+            token, expires = self.request_token()
+            self.token_expires = expires
+            self.token = token
+            return token
+
+    def request_token(self):
+        """Get a new API token using the credentials, return it and its expiry"""
+        logger.debug("Getting a new token for %s on %s", self.user, self.host)
+        issued = time.time()
+        try:
+            response = self.session.get(urljoin(self.host, "/auth/v1/token"), timeout=self.timeout,
+                                        auth=requests.auth.HTTPBasicAuth(self.user, self.password))
+        except requests.exceptions.RequestException as exc:
+            logger.error('Application failed to obtain token (%s)', str(exc))
+            raise DiscoverError("Attempt to obtain token failed (%s)" % str(exc))
+        if response.status_code != 200:
+            logger.error('Application failed to obtain token (%d)', response.status_code)
+            raise DiscoverError("Attempt to obtain token returned (%d)" % response.status_code)
+        token = response.headers['X-Auth-Token']
+        expires = token_expiry(token) or issued + self.token_lifetime
+        logger.debug("New token expires in %ds", expires - issued)
+        return token, expires
+
+    def post(self, path, json_body):
+        """POST a JSON body to an API path, renewing the token on 401"""
+        url = urljoin(self.host, path)
+        token = self.get_token()
+        try:
+            response = self.session.post(url, json=json_body, timeout=self.timeout,
+                                         headers={'Authorization': 'Bearer %s' % token})
+            #API token may have been revoked, renew it and retry the query
+            if response.status_code == 401:
+                logger.debug("A new token is required")
+                token = self.get_token(rejected=token)
+                response = self.session.post(url, json=json_body, timeout=self.timeout,
+                                             headers={'Authorization': 'Bearer %s' % token})
+        except requests.exceptions.RequestException as exc:
+            raise DiscoverError("%s failed (%s)" % (path, str(exc)))
+        if response.status_code != 200:
+            raise DiscoverError("%s failed with code %d" % (path, response.status_code))
+        return response.json()
+
+    def search(self, json_query):
+        """Run a search query on Discover and return the matching rows"""
+        return json.loads(self.post("/db2whrest/v1/search", json_query)["rows"])
+
+    def search_pages(self, json_query, page_size=10000, prefetch=0):
+        """Run a search query on Discover and yield its rows page by page
+
+        Pages are requested with limit/offset and sorted on fkey (unless the
+        query sorts), so only one page of rows is decoded at a time whatever
+        the size of the result. With prefetch, that many following pages are
+        requested in parallel while the current one is consumed. The "limit"
+        of the query, if any, caps the total number of rows.
+        """
+        total = json_query.get("limit")
+        query = dict(json_query, limit=page_size, sort_by=json_query.get("sort_by") or ["fkey"])
+        fetch = lambda page: self.search(dict(query, offset=page * page_size))
+        pages = itertools.count()
+        returned = 0
+        with ThreadPoolExecutor(max_workers=max(prefetch, 1)) as executor:
+            pending = deque(executor.submit(fetch, next(pages)) for _ in range(prefetch + 1))
+            while True:
+                rows = pending.popleft().result()
+                if total:
+                    rows = rows[:total - returned]
+                returned += len(rows)
+                if rows:
+                    yield rows
+                if len(rows) < page_size or returned == total:
+                    # Last page, drop the pages requested past the end
+                    for future in pending:
+                        future.cancel()
+                    return
+                pending.append(executor.submit(fetch, next(pages)))
+
+    def close(self):
+        """Close all pooled connections."""
+        self.session.close()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Local stand-in for the Spectrum Discover REST API, to try the applications
+and the Discover client without a Discover instance.
+
+Serves:
+    GET  /auth/v1/token ........... basic auth, answers an X-Auth-Token JWT
+                                    expiring after --token-lifetime seconds
+    POST /db2whrest/v1/search ..... bearer auth, searches the --records JSON
+                                    list (queries "fkey = '..'" and
+                                    "fkey IN ('..', ..)", optionally
+                                    "(..) AND mtime >= '..'", anything
+                                    else matches all records), honours
+                                    "group_by" (field names, one row per
+                                    group with its "count"), "sort_by"
+                                    (field names), "offset" and "limit"
+
+    python3 discover_stub_server.py --port 8080 --records records.json
+"""
+
+import re
+import sys
+import json
+import time
+import uuid
+import base64
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+FKEY_QUERY = re.compile(r"^\s*fkey\s*(=|IN)\s*(.*)$", re.IGNORECASE)
+MTIME_FILTER = re.compile(r"^\((.*)\) AND mtime >= '((?:[^']|'')*)'$", re.IGNORECASE)
+QUOTED = re.compile(r"'((?:[^']|'')*)'")
+
+
+def b64(data):
+    return base64.urlsafe_b64encode(json.dumps(data).encode("utf-8")).rstrip(b"=").decode("ascii")
+
+
+def match_query(query, records):
+    """Return the records matching a search query"""
+    match = MTIME_FILTER.match(query or "")
+    if match:
+        since = match.group(2).replace("''", "'")
+        return [record for record in match_query(match.group(1), records) if str(record.get("mtime", "")) >= since]
+    match = FKEY_QUERY.match(query or "")
+    if not match:
+        return list(records)
+    fkeys = {value.replace("''", "'") for value in QUOTED.findall(match.group(2))}
+    return [record for record in records if record.get("fkey") in fkeys]
+
+
+def group_rows(rows, fields):
+    """Return one row per distinct value of fields, with its count"""
+    counts = {}
+    for row in rows:
+        group = tuple(row.get(field) for field in fields)
+        counts[group] = counts.get(group, 0) + 1
+    return [dict(zip(fields, group), count=count) for group, count in counts.items()]
+
+
+class DiscoverStub():
+    """State of the stub: credentials, issued tokens and records"""
+
+    def __init__(self, user, password, records, token_lifetime=3600):
+        self.user = user
+        self.password = password
+        self.records = records
+        self.token_lifetime = token_lifetime
+        self.tokens = {}
+        self.lock = threading.Lock()
+        self.counts = {"token": 0, "search": 0, "unauthorized": 0}
+
+    def issue_token(self):
+        expires = time.time() + self.token_lifetime
+        token = "%s.%s.stub" % (b64({"alg": "none", "typ": "JWT"}),
+                                b64({"sub": self.user, "exp": int(expires), "jti": uuid.uuid4().hex}))
+        with self.lock:
+            self.tokens[token] = expires
+            self.counts["token"] += 1
+        return token
+
+    def valid_token(self, token):
+        with self.lock:
+            return self.tokens.get(token, 0) > time.time()
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+
+class Handler(BaseHTTPRequestHandler):
+    stub = None
+
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path != "/auth/v1/token":
+            return self.send_json(404, {"error": "not found"})
+        expected = "Basic " + base64.b64encode(("%s:%s" % (self.stub.user, self.stub.password)).encode()).decode()
+        if self.headers.get("Authorization") != expected:
+            return self.send_json(401, {"error": "invalid credentials"})
+        self.send_json(200, {}, {"X-Auth-Token": self.stub.issue_token()})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path != "/db2whrest/v1/search":
+            return self.send_json(404, {"error": "not found"})
+        auth = self.headers.get("Authorization", "")
+        if not auth.startswith("Bearer ") or not self.stub.valid_token(auth[len("Bearer "):]):
+            self.stub.count("unauthorized")
+            return self.send_json(401, {"error": "invalid token"})
+        self.stub.count("search")
+        query = json.loads(body or b"{}")
+        rows = match_query(query.get("query"), self.stub.records)
+        if query.get("group_by"):
+            rows = group_rows(rows, query["group_by"])
+        for field in reversed(query.get("sort_by") or []):
+            rows.sort(key=lambda row: str(row.get(field, "")))
+        offset = query.get("offset") or 0
+        rows = rows[offset:offset + query["limit"]] if query.get("limit") else rows[offset:]
+        # Discover answers the rows as a JSON string
+        self.send_json(200, {"rows": json.dumps(rows)})
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(stub, host="localhost", port=0):
+    """Start the stub server in a thread, return the server (see server_address)"""
+    handler = type("StubHandler", (Handler,), {"stub": stub})
+    server = ThreadingHTTPServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--user", default="user")
+    parser.add_argument("--password", default="password")
+    parser.add_argument("--records", help="JSON file with the list of records to search")
+    parser.add_argument("--token-lifetime", type=float, default=3600, help="token lifetime in seconds")
+    args = parser.parse_args()
+
+    records = []
+    if args.records:
+        with open(args.records) as f:
+            records = json.load(f)
+    stub = DiscoverStub(args.user, args.password, records, args.token_lifetime)
+    server = serve(stub, args.host, args.port)
+    print("Discover stub serving %d records on http://%s:%d" % (len(records), *server.server_address[:2]))
+    try:
+        while True:
+            time.sleep(60)
+            print("Requests: %s" % stub.counts)
+    except KeyboardInterrupt:
+        server.shutdown()
+        sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
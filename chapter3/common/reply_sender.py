@@ -0,0 +1,229 @@
+#!/usr/bin/python -W ignore
+########################################################## {COPYRIGHT-TOP} ###
+# Licensed Materials - Property of IBM
+# 5737-I32
+#
+# (C) Copyright IBM Corp. 2019
+#
+# US Government Users Restricted Rights - Use, duplication, or
+# disclosure restricted by GSA ADP Schedule Contract with IBM Corp.
+########################################################## {COPYRIGHT-END} ###
+"""Reply sending in the background, and polling of the work messages.
+
+ApplicationMessageBase.send_reply() produces a reply, waits for its delivery
+and commits the consumer position before the agent can poll the next work
+message. Here the replies are queued to a sender thread, which delivers them
+while the agent reads and processes the next messages, and commits the
+offset of a work message once its last reply is delivered. A large work
+message can be replied to in several parts, the first results being sent
+while the rest are processed.
+"""
+
+import json
+import time
+import queue
+import logging
+import threading
+from confluent_kafka import TopicPartition
+
+logger = logging.getLogger(__name__)
+
+def read_work_message(am, timeout):
+    """Poll a work message, like am.read_message()
+
+    Returns a (msg, message) tuple: the decoded work message (None when the
+    poll timed out, or the message is invalid or of an ignored run) and the
+    Kafka message, whose offset is committed by ReplySender.
+    """
+    message = am.kafka_consumer.poll(timeout=timeout)
+    msg = None
+    if message:
+        try:
+            msg = am.decode_msg(message)
+        except json.decoder.JSONDecodeError:
+            logger.error("Message decode error - invalid JSON")
+        if message.error():
+            message = None
+    try:
+        if msg['run_id'] in am.application.kafka_ignored_run_ids:
+            logger.debug("Dropping message due to ignored run_id %s", msg['run_id'])
+            msg = None
+    except (TypeError, KeyError):
+        pass
+    return msg, message
+
+class PollTimeout():
+    """Poll timeout adapting to the backlog of work messages.
+
+    The timeout is minimum after a message, and doubles on every empty poll
+    up to maximum, so that a busy agent goes back to its messages right away
+    and an idle one polls rarely.
+    """
+
+    def __init__(self, minimum=1, maximum=30):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.timeout = minimum
+
+    def next(self, got_message):
+        """Return the timeout of the next poll, after one that got a message or not"""
+        if got_message:
+            self.timeout = self.minimum
+        else:
+            self.timeout = min(self.timeout * 2, self.maximum)
+        return self.timeout
+
+class ReplySender():
+    """Background delivery of the replies to the work messages.
+
+    send() queues a reply, and the sender thread produces the queued replies,
+    waits for their delivery and commits the offsets of their work messages.
+    At most max_pending replies are queued, send() blocking beyond that.
+    Replies are delivered and offsets committed in the order they are sent,
+    undelivered replies being retried (from retry_delay up to max_retry_delay
+    seconds apart) before any later offset is committed, until close() gives
+    up on them.
+    Deliveries are timed into metrics, when given.
+    """
+
+    def __init__(self, am, max_pending=4, chunk_size=0, metrics=None, retry_delay=1, max_retry_delay=30):
+        self.am = am
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.metrics = metrics
+        self.chunk_size = chunk_size
+        self.pending = queue.Queue(maxsize=max_pending)
+        self.lock = threading.Lock()
+        # Set by close() to give up on the replies not delivered yet
+        self.stopping = threading.Event()
+        self.sent = 0
+        self.partial = 0
+        self.failed = 0
+        self.commits = 0
+        self.delivery_time = 0.0
+        self.thread = threading.Thread(target=self.run, name='reply_sender', daemon=True)
+        self.thread.start()
+
+    def send(self, reply, message=None):
+        """Queue a reply, and the commit of its Kafka message when given
+
+        reply may be None to only commit the message.
+        """
+        self.pending.put((reply, message))
+
+    def send_partial(self, reply, msg):
+        """Queue a reply with chunk_size results or more, keeping the work message uncommitted
+
+        Returns the reply to add the next results to: a new one when reply
+        was queued, else reply itself.
+        """
+        if not self.chunk_size or len(reply.reply['docs']) < self.chunk_size:
+            return reply
+        with self.lock:
+            self.partial += 1
+        self.send(reply)
+        return type(reply)(msg)
+
+    def run(self):
+        while not self.stopping.is_set():
+            items = [self.pending.get()]
+            # Whatever else is queued is delivered along
+            while True:
+                try:
+                    items.append(self.pending.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.deliver([item for item in items if item is not None])
+            except Exception as exc:
+                logger.error("Error while sending replies: %s", str(exc))
+            for _ in items:
+                self.pending.task_done()
+            if None in items:
+                return
+
+    def deliver(self, items):
+        start = time.time()
+        # An empty reply (the rest of a message sent in parts) is only committed
+        replies = [reply for reply, _ in items if reply is not None and reply.reply['docs']]
+        produced = bool(replies)
+        delay = self.retry_delay
+        while replies:
+            failed = self.produce(replies)
+            if not failed:
+                break
+            # A work message is committed only once all its replies are
+            # delivered, and later offsets of its partition cannot be committed
+            # before it: retry until the replies get through (a stop meanwhile
+            # leaves the messages uncommitted, processed again after a restart)
+            logger.error("%d replies not delivered, retrying in %gs", len(failed), delay)
+            if self.stopping.wait(delay):
+                logger.error("Stopping, %d replies not delivered and their messages not committed", len(failed))
+                return
+            delay = min(delay * 2, self.max_retry_delay)
+            replies = failed
+        elapsed = time.time() - start
+        with self.lock:
+            self.delivery_time += elapsed
+        if self.metrics and produced:
+            self.metrics.observe('stage_seconds', elapsed, stage='reply')
+        # Next offset to read, of the last message of each partition
+        offsets = {}
+        for reply, message in items:
+            if message is not None:
+                offsets[(message.topic(), message.partition())] = message.offset() + 1
+        if offsets:
+            self.am.kafka_consumer.commit(offsets=[TopicPartition(topic, partition, offset)
+                                                   for (topic, partition), offset in offsets.items()],
+                                          asynchronous=False)
+            with self.lock:
+                self.commits += 1
+
+    def produce(self, replies):
+        """Produce replies and wait for their delivery, return the ones not delivered"""
+        delivered = []
+        def acked(reply):
+            def callback(err, msg):
+                self.am.producer_acked(err, msg)
+                if err is None:
+                    delivered.append(reply)
+            return callback
+        for reply in replies:
+            self.am.kafka_producer.produce(self.am.compl_q_name, str(reply), callback=acked(reply))
+        # Replies still in flight when close() gives up count as not delivered
+        while self.am.kafka_producer.flush(1) and not self.stopping.is_set():
+            pass
+        failed = len(replies) - len(delivered)
+        with self.lock:
+            self.sent += len(delivered)
+            self.failed += failed
+        if self.metrics:
+            self.metrics.inc('replies_total', len(delivered), outcome='sent')
+            self.metrics.inc('replies_total', failed, outcome='failed')
+        # In the order they were sent
+        return [reply for reply in replies if reply not in delivered]
+
+    def close(self, timeout=None):
+        """Deliver the queued replies and stop the sender thread
+
+        After timeout seconds, the replies not delivered yet are given up,
+        and their work messages left uncommitted.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        remaining = lambda: None if deadline is None else max(0, deadline - time.time())
+        try:
+            self.pending.put(None, timeout=remaining())
+        except queue.Full:
+            pass
+        self.thread.join(remaining())
+        if self.thread.is_alive():
+            logger.error("Replies not delivered within %ss, giving up", timeout)
+            self.stopping.set()
+            self.thread.join(5)
+
+    def stats(self):
+        """Return the reply counters."""
+        with self.lock:
+            return {'sent': self.sent, 'partial': self.partial, 'failed': self.failed,
+                    'commits': self.commits, 'pending': self.pending.qsize(),
+                    'delivery_time': self.delivery_time}
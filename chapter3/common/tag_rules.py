@@ -0,0 +1,79 @@
+#!/usr/bin/python -W ignore
+########################################################## {COPYRIGHT-TOP} ###
+# Licensed Materials - Property of IBM
+# 5737-I32
+#
+# (C) Copyright IBM Corp. 2019
+#
+# US Government Users Restricted Rights - Use, duplication, or
+# disclosure restricted by GSA ADP Schedule Contract with IBM Corp.
+########################################################## {COPYRIGHT-END} ###
+"""Mapping of the tags to extract to the fields of a result.
+
+The rules are an ordered JSON object of tag substrings to field names, e.g.
+
+    {"segfile": "filename_seg", "nodules_count": "nodules_count"}
+
+A tag gets the value of the field of the first rule whose substring it
+contains (inference_nodules_count gets nodules_count), and an empty value
+when no rule matches. The rules are given inline or as the path of a JSON
+file, in the TAG_RULES environment variable of the agent.
+
+The extract_tags list of a policy is matched against the rules once, and
+the result cached: per document, tags are then a dict lookup of the fields.
+"""
+
+import os
+import json
+import logging
+import functools
+
+logger = logging.getLogger(__name__)
+
+class TagRules():
+    """Ordered (tag substring, field) rules."""
+
+    def __init__(self, rules, fields=None):
+        """rules is a list of (substring, field) pairs, fields the known field names"""
+        self.rules = list(rules)
+        if fields is not None:
+            unknown = [field for _, field in self.rules if field not in fields]
+            if unknown:
+                raise ValueError("Unknown field(s) in tag rules: %s" % ", ".join(unknown))
+        self.compile = functools.lru_cache(maxsize=128)(self._compile)
+
+    @classmethod
+    def from_env(cls, default, fields=None, name="TAG_RULES"):
+        """Rules from the JSON object (or JSON file) in environment variable name, else default"""
+        value = os.environ.get(name, "").strip()
+        if not value:
+            return cls(default.items(), fields)
+        try:
+            if value.startswith("{"):
+                rules = json.loads(value)
+            else:
+                with open(value) as rules_file:
+                    rules = json.load(rules_file)
+        except (OSError, json.decoder.JSONDecodeError) as ex:
+            raise ValueError("Invalid %s: %s" % (name, ex))
+        if not isinstance(rules, dict):
+            raise ValueError("%s must be a JSON object of tag substrings to fields" % name)
+        return cls(rules.items(), fields)
+
+    def _compile(self, tags):
+        # tags is a tuple, to be hashable
+        mapping = tuple((tag, self.field(tag)) for tag in tags)
+        logger.debug("Tag mapping: %s", mapping)
+        return mapping
+
+    def field(self, tag):
+        """Return the field of a tag, None when no rule matches"""
+        for substring, field in self.rules:
+            if substring in tag:
+                return field
+        return None
+
+    @staticmethod
+    def apply(mapping, values):
+        """Return the tags of a compiled mapping, from a dict of field values"""
+        return {tag: values[field] if field else "" for tag, field in mapping}